@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+'''
+Local stand-in for a network of web servers, for benchmarking webshooter offline.
+
+Each port serves one kind of target:
+    fast      small static page
+    slow      small page sent after a delay
+    hang      accepts the connection and never answers
+    redirect  a chain of redirects that ends on a small page
+    heavy     page that pulls in many large images
+    tls       small page over HTTPS with a self-signed certificate
+
+Every port serves any path, so a port can stand in for many URLs. Runs until interrupted.
+'''
+import os
+import sys
+import json
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import ssl
+
+KINDS = ['fast', 'slow', 'hang', 'redirect', 'heavy', 'tls']
+# avoid the ports browsers refuse to connect to
+DEFAULT_BASE_PORT = 18000
+SLOW_DELAY_S = 2.0
+REDIRECT_HOPS = 3
+HEAVY_ASSETS = 20
+HEAVY_ASSET_SIZE = 256 * 1024
+
+PAGE = '''<!DOCTYPE html>
+<html><head><title>{kind} {path}</title></head>
+<body><h1>{kind}</h1><p>{path}</p>{extra}</body></html>
+'''
+
+def make_certificate(directory: str) -> tuple[str, str]:
+    ''' self-signed certificate and key for localhost, made with the openssl command '''
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2', '-subj', '/CN=localhost',
+                    '-keyout', key, '-out', cert], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def response(status: str, body: bytes, content_type: str='text/html; charset=utf-8', headers: dict=None) -> bytes:
+    head = ['HTTP/1.1 ' + status, 'Content-Type: ' + content_type, 'Content-Length: {}'.format(len(body)),
+            'Server: webshooter-farm', 'Connection: keep-alive']
+    head += ['{}: {}'.format(k, v) for k, v in (headers or {}).items()]
+    return ('\r\n'.join(head) + '\r\n\r\n').encode() + body
+
+def page(kind: str, path: str, extra: str='') -> bytes:
+    return response('200 OK', PAGE.format(kind=kind, path=path, extra=extra).encode())
+
+class Target():
+    ''' one listening port serving one kind of target '''
+    def __init__(self, kind: str, port: int, slow_delay_s: float=SLOW_DELAY_S):
+        self.kind = kind
+        self.port = port
+        self.slow_delay_s = slow_delay_s
+        self.asset = os.urandom(HEAVY_ASSET_SIZE)
+    @property
+    def scheme(self) -> str:
+        return 'https' if self.kind == 'tls' else 'http'
+    def url(self, i: int) -> str:
+        return '{}://127.0.0.1:{}/page/{}'.format(self.scheme, self.port, i)
+    async def respond(self, path: str) -> bytes:
+        if self.kind == 'slow':
+            await asyncio.sleep(self.slow_delay_s)
+        elif self.kind == 'redirect':
+            base, _, hop = path.partition('/hop/')
+            hop = int(hop) if hop.isdigit() else 0
+            if hop < REDIRECT_HOPS:
+                return response('302 Found', b'', headers={'Location': '{}/hop/{}'.format(base, hop + 1)})
+        elif self.kind == 'heavy':
+            if path.startswith('/asset/'):
+                # any bytes will do. the browser only has to fetch and try to decode them
+                return response('200 OK', self.asset, 'image/jpeg', {'Cache-Control': 'no-store'})
+            images = ''.join('<img src="/asset/{}?{}" width="64" height="64">'.format(n, path) for n in range(HEAVY_ASSETS))
+            return page(self.kind, path, images)
+        return page(self.kind, path)
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                if self.kind == 'hang':
+                    # hold the connection open until the client gives up
+                    await reader.read()
+                    return
+                path = head.split(b' ', 2)[1].decode('latin-1')
+                writer.write(await self.respond(path))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, IndexError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+async def serve(targets: list[Target], ssl_context: ssl.SSLContext=None, ready=None):
+    servers = []
+    for t in targets:
+        servers.append(await asyncio.start_server(t.handle, '127.0.0.1', t.port,
+                                                  ssl=ssl_context if t.kind == 'tls' else None))
+    if ready:
+        ready()
+    await asyncio.gather(*[s.serve_forever() for s in servers])
+
+def build_targets(kinds: list[str], ports_per_kind: int, base_port: int, slow_delay_s: float) -> list[Target]:
+    targets = []
+    port = base_port
+    for kind in kinds:
+        for _ in range(ports_per_kind):
+            targets.append(Target(kind, port, slow_delay_s))
+            port += 1
+    return targets
+
+def target_urls(targets: list[Target], urls_per_port: int) -> list[str]:
+    # interleave ports so consecutive URLs hit different servers, like a real target list
+    return [t.url(i) for i in range(urls_per_port) for t in targets]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kinds', default=','.join(KINDS), help='target kinds to serve. default all')
+    parser.add_argument('--ports-per-kind', default=4, type=int, help='listening ports per kind. default %(default)s')
+    parser.add_argument('--urls-per-port', default=10, type=int, help='distinct URLs listed per port. default %(default)s')
+    parser.add_argument('--base-port', default=DEFAULT_BASE_PORT, type=int, help='first port. default %(default)s')
+    parser.add_argument('--slow-delay', default=SLOW_DELAY_S, type=float, help='seconds slow pages wait. default %(default)s')
+    parser.add_argument('--url-file', default=None, help='write the target URLs here, 1 per line')
+    args = parser.parse_args()
+
+    kinds = [k for k in args.kinds.split(',') if k]
+    unknown = set(kinds) - set(KINDS)
+    if unknown:
+        parser.error('unknown kind(s): ' + ','.join(sorted(unknown)))
+    targets = build_targets(kinds, args.ports_per_kind, args.base_port, args.slow_delay)
+    urls = target_urls(targets, args.urls_per_port)
+    if args.url_file:
+        with open(args.url_file, 'w') as fp:
+            fp.write('\n'.join(urls) + '\n')
+
+    cert_dir = tempfile.mkdtemp(prefix='webshooter-farm-')
+    try:
+        ssl_context = None
+        if 'tls' in kinds:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain(*make_certificate(cert_dir))
+        def ready():
+            # the benchmark runner waits for this line
+            print(json.dumps({'ready': True, 'ports': len(targets), 'urls': len(urls),
+                              'kinds': {k: args.ports_per_kind * args.urls_per_port for k in kinds}}), flush=True)
+        asyncio.run(serve(targets, ssl_context, ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(cert_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
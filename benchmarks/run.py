@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+'''
+Throughput benchmark for webshooter. Starts the local target farm (farm.py), scans it with a
+fresh `webshooter scan` for every combination of thread count and option profile, and prints
+JSON that can be saved and compared between versions.
+
+Each run reports URLs per second, p50/p95 capture latency, peak memory of the scan and
+everything it started (node and Chromium included), and the size of the session and images.
+Everything runs on localhost. Nothing needs network access.
+'''
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from webshooter.screen.session import Status, Stage, WebShooterSession
+from webshooter.screen.procstat import tree_rss
+from webshooter.screen.stats import percentile
+
+FARM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'farm.py')
+# scan options compared by default. any other set can be given with --profile name=args
+PROFILES = {
+    'default': [],
+    'lean': ['--lean'],
+    'jpeg': ['--format', 'jpeg'],
+    'adaptive': ['--adaptive-wait'],
+    'inline': ['--transport', 'inline'],
+}
+RSS_INTERVAL_S = 0.2
+FARM_START_TIMEOUT_S = 30
+
+def start_farm(args, url_file: str) -> tuple[subprocess.Popen, dict]:
+    farm = subprocess.Popen([sys.executable, FARM, '--kinds', args.kinds, '--ports-per-kind', str(args.ports_per_kind),
+                             '--urls-per-port', str(args.urls_per_port), '--base-port', str(args.base_port),
+                             '--slow-delay', str(args.slow_delay), '--url-file', url_file],
+                            stdout=subprocess.PIPE, text=True)
+    # read on a thread so a farm that hangs before its ready line cannot block past the deadline
+    lines = queue.Queue()
+    def read():
+        for line in farm.stdout:
+            lines.put(line)
+        lines.put(None)
+    threading.Thread(target=read, daemon=True).start()
+    deadline = time.monotonic() + FARM_START_TIMEOUT_S
+    while True:
+        try:
+            line = lines.get(timeout=max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            break
+        if line is None:
+            break
+        info = json.loads(line)
+        if info.get('ready'):
+            return farm, info
+    farm.kill()
+    farm.wait()
+    raise RuntimeError('target farm did not start')
+
+def scan_command(session_file: str, url_file: str, threads: int, options: list[str], args) -> list[str]:
+    return [sys.executable, '-c', 'import sys; sys.argv[0] = "webshooter"; from webshooter.cli import run; run()',
+            '-s', session_file, 'scan', '-u', url_file, '--threads', str(threads),
+            '--page-timeout', str(args.page_timeout_ms), '--screen-wait', str(args.screen_wait_ms), *options]
+
+def dir_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def session_size(session_file: str) -> int:
+    return sum(os.path.getsize(session_file + ext) for ext in ('', '-wal') if os.path.exists(session_file + ext))
+
+def run_scan(url_file: str, profile: str, options: list[str], threads: int, repeat: int, args) -> dict:
+    workdir = tempfile.mkdtemp(prefix='webshooter-bench-')
+    session_file = os.path.join(workdir, 'bench.db')
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in [os.path.join(os.path.dirname(FARM), '..', 'src'),
+                                                    env.get('PYTHONPATH')] if p)
+    result = {'profile': profile, 'options': options, 'threads': threads, 'repeat': repeat}
+    try:
+        # scans log every failed URL. a pipe nobody reads until exit would fill up and stall the scan
+        with open(os.path.join(workdir, 'scan.log'), 'w+') as log:
+            start = time.monotonic()
+            proc = subprocess.Popen(scan_command(session_file, url_file, threads, options, args), cwd=workdir, env=env,
+                                    stdout=subprocess.DEVNULL, stderr=log)
+            peak_rss = 0
+            while proc.poll() is None:
+                peak_rss = max(peak_rss, tree_rss([proc.pid]) or 0)
+                time.sleep(RSS_INTERVAL_S)
+            wall_s = time.monotonic() - start
+            log.seek(0)
+            stderr = log.read()
+        result.update({'returncode': proc.returncode, 'wall_s': round(wall_s, 3), 'peak_rss_bytes': peak_rss})
+        if proc.returncode != 0:
+            result['error'] = stderr.strip().splitlines()[-5:]
+        if not os.path.exists(session_file):
+            return result
+        with WebShooterSession(session_file) as session:
+            statuses = {name.lower(): session.count_urls([value]) for name, value in vars(Status).items()
+                        if not name.startswith('_')}
+            latencies = session.get_stage_times(Stage.TOTAL)
+        done = sum(n for name, n in statuses.items() if name != 'queued')
+        result.update({
+            'urls': sum(statuses.values()),
+            'statuses': statuses,
+            'urls_per_s': round(done / wall_s, 3) if wall_s > 0 else None,
+            'latency_ms': {'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95)},
+            'session_bytes': session_size(session_file),
+            'images_bytes': dir_size(os.path.join(workdir, 'images')),
+        })
+        return result
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            result['workdir'] = workdir
+
+def git_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(FARM), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_profile(value: str) -> tuple[str, list[str]]:
+    name, _, options = value.partition('=')
+    return name, options.split() if options else PROFILES.get(name, [])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', default='4,8,16', help='comma separated thread counts. default %(default)s')
+    parser.add_argument('--profile', action='append', dest='profiles', type=parse_profile, default=[],
+                        help='option profile to run: a built in name ({}) or name="scan options". repeatable. '
+                        'default all built in profiles'.format(', '.join(PROFILES)))
+    parser.add_argument('--repeat', default=1, type=int, help='runs of each combination. default %(default)s')
+    parser.add_argument('--kinds', default='fast,slow,hang,redirect,heavy,tls', help='target kinds. default %(default)s')
+    parser.add_argument('--ports-per-kind', default=4, type=int, help='default %(default)s')
+    parser.add_argument('--urls-per-port', default=10, type=int, help='default %(default)s')
+    parser.add_argument('--base-port', default=18000, type=int, help='default %(default)s')
+    parser.add_argument('--slow-delay', default=2.0, type=float, help='seconds slow targets wait. default %(default)s')
+    parser.add_argument('--page-timeout', dest='page_timeout_ms', default=5000, type=int, help='default %(default)s')
+    parser.add_argument('--screen-wait', dest='screen_wait_ms', default=500, type=int, help='default %(default)s')
+    parser.add_argument('-o', '--output', default=None, help='write JSON here instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='keep each run\'s session and images')
+    args = parser.parse_args()
+    profiles = args.profiles or list(PROFILES.items())
+    threads = [int(t) for t in args.threads.split(',')]
+
+    tmp = tempfile.mkdtemp(prefix='webshooter-farm-urls-')
+    url_file = os.path.join(tmp, 'urls.txt')
+    farm, farm_info = start_farm(args, url_file)
+    runs = []
+    try:
+        for name, options in profiles:
+            for t in threads:
+                for r in range(args.repeat):
+                    print('Running {} with {} thread(s), run {}'.format(name, t, r + 1), file=sys.stderr)
+                    runs.append(run_scan(url_file, name, options, t, r, args))
+    finally:
+        farm.terminate()
+        farm.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        'version': git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'farm': {k: v for k, v in farm_info.items() if k != 'ready'},
+        'settings': {'page_timeout_ms': args.page_timeout_ms, 'screen_wait_ms': args.screen_wait_ms,
+                     'slow_delay_s': args.slow_delay},
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    sys.exit(main())
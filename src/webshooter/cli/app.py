@@ -1,5 +1,9 @@
+import json
+import time
 import logging
 import argparse
+import itertools
+from collections.abc import Iterator
 
 from webshooter import targets
 from webshooter import report
@@ -10,59 +14,218 @@ logger = logging.getLogger(__package__)
 
 DEFAULT_HTTP_PORTS = {80, 8080}
 DEFAULT_HTTPS_PORTS = {443, 8443}
+# URLs handed to the probe at a time
+PROBE_CHUNK_SIZE = 50000
 
 def split_ports(ports: str) -> set[int]:
     return set(map(int, ports.split(',')))
 
+def split_timeouts(timeouts: str) -> list[int]:
+    return list(map(int, timeouts.split(',')))
+
+def split_resource_types(types: str) -> list[str]:
+    types = [t.strip().lower() for t in types.split(',') if t.strip()]
+    unknown = set(types) - set(screen.capture.RESOURCE_TYPES)
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown resource type(s): {}. choose from {}'.format(
+            ','.join(sorted(unknown)), ','.join(screen.capture.RESOURCE_TYPES)))
+    return types
+
+def split_views(views: str) -> list[str]:
+    views = [v.strip().lower() for v in views.split(',') if v.strip()]
+    unknown = set(views) - set(screen.capture.View.ALL)
+    if unknown:
+        raise argparse.ArgumentTypeError('unknown view(s): {}. choose from {}'.format(
+            ','.join(sorted(unknown)), ','.join(screen.capture.View.ALL)))
+    return views
+
+def block_profile(args) -> screen.capture.BlockProfile:
+    ''' requests for the capture service to abort, or None to load everything '''
+    profile = {'types': [], 'patterns': [], 'third_party': False}
+    if args.lean:
+        profile = {k: (list(v) if isinstance(v, list) else v) for k, v in screen.capture.LEAN_PROFILE.items()}
+    profile['types'] += [t for t in args.block_types if t not in profile['types']]
+    profile['patterns'] += args.block_urls
+    profile['third_party'] = profile['third_party'] or args.block_third_party
+    if not (profile['types'] or profile['patterns'] or profile['third_party']):
+        return None
+    return profile
+
 def handle_scan(args):
     # get urls to screenshot
     if args.all_open:
         args.ports_http = set(range(1, 2**16))
         args.ports_https = set(range(1, 2**16))
 
-    urls = set()
-    if args.urls:
-        urls.update(targets.urls.from_iterator(args.urls))
+    # Stream targets straight into the session. The session will dedupe URLs.
+    sources = [targets.urls.from_iterator(args.urls)]
     for ufile in args.url_file:
-        urls.update(targets.urls.from_file(ufile))
+        sources.append(targets.urls.from_file(ufile))
     for nxml in args.nmap_xml:
-        urls.update(targets.nmap.from_xml(nxml, args.ports_http, args.ports_https))
+        sources.append(targets.nmap.from_xml(nxml, args.ports_http, args.ports_https, args.nmap_services))
     for nxml in args.nessus_xml:
-        urls.update(targets.nessus.from_xml(nxml, args.ports_http, args.ports_https))
+        sources.append(targets.nessus.from_xml(nxml, args.ports_http, args.ports_https))
+
+    # closing the session commits any captures still queued for writing, even on Ctrl-C
+    with screen.session.WebShooterSession(args.session) as session:
+        added = session.add_urls(itertools.chain(*sources))
+        logger.info('Added %d new URL(s) to the session', added)
+        scan_session(args, session)
+
+def url_chunks(session: screen.session.WebShooterSession, statuses: list[screen.session.Status]) -> Iterator[list[str]]:
+    ''' session URLs in chunks for the network checks that run before a scan '''
+    urls = session.iter_urls(statuses)
+    while True:
+        # URLs for the same host:port are usually added together so chunking rarely splits them
+        chunk = list(itertools.islice(urls, PROBE_CHUNK_SIZE))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def probe_session(args, session: screen.session.WebShooterSession, statuses: list[screen.session.Status]):
+    if args.proxy:
+        logger.warning('Skipping probe: targets are reached through a proxy')
+        return
+    Scheme = targets.probe.Scheme
+    invalid_count = 0
+    scheme_counts = {Scheme.CLOSED: 0, Scheme.PLAIN: 0, Scheme.TLS: 0}
+    for chunk in url_chunks(session, statuses):
+        invalid, schemes = targets.probe.probe_urls(chunk, args.probe_timeout_ms / 1000, args.probe_concurrency)
+        for (host, port), scheme in schemes.items():
+            logger.info('%s:%d %s', host, port, 'closed' if scheme is Scheme.CLOSED else 'speaks ' + scheme)
+            scheme_counts[scheme] += 1
+        if args.dryrun:
+            for u in sorted(invalid):
+                print('Would skip', u)
+        else:
+            session.update_urls(list(invalid), screen.session.Status.INVALID)
+        invalid_count += len(invalid)
+    print('Probe found {} closed port(s), {} speaking plain HTTP and {} speaking TLS'.format(
+        scheme_counts[Scheme.CLOSED], scheme_counts[Scheme.PLAIN], scheme_counts[Scheme.TLS]))
+    print('Probe found {} unreachable or wrong-scheme URL(s){}'.format(
+        invalid_count, '' if not args.dryrun else ' (dry run, session unchanged)'))
 
-    # The session will dedupe URLs. We add failed URLs back in if requested.
-    session = screen.session.WebShooterSession(args.session, urls)
-    urls = set(session.get_queued_urls())
+def resolve_session(args, session: screen.session.WebShooterSession, statuses: list[screen.session.Status]):
+    if args.proxy:
+        logger.warning('Skipping redirect resolution: targets are reached through a proxy')
+        return
+    # normalized final URL -> URL kept for the browser. shared across chunks
+    representatives = {}
+    duplicate_count = 0
+    for chunk in url_chunks(session, statuses):
+        duplicates = targets.redirects.find_duplicates(chunk, args.probe_timeout_ms / 1000, args.probe_concurrency,
+                                                       representatives)
+        if args.dryrun:
+            for url, rep in duplicates:
+                print('Would skip {} for {}'.format(url, rep))
+        else:
+            session.mark_duplicates(duplicates)
+        duplicate_count += len(duplicates)
+    print('Redirects lead {} URL(s) to a page that is already being captured{}'.format(
+        duplicate_count, '' if not args.dryrun else ' (dry run, session unchanged)'))
+
+def scan_session(args, session: screen.session.WebShooterSession):
+    Status = screen.session.Status
+    statuses = [Status.QUEUED]
+    # We add failed URLs back in if requested.
     if args.retry:
-        failed_urls = session.get_failed_urls()
-        print('Retrying {} failed URL(s)'.format(len(failed_urls)))
-        for u in failed_urls:
-            logger.debug('retrying failed URL: %s', u)
-        urls.update(failed_urls)
+        statuses += [Status.ERROR, Status.TIMEOUT]
+        print('Retrying {} failed URL(s)'.format(session.count_urls([Status.ERROR, Status.TIMEOUT])))
 
-    print('Shooting {} URL(s)'.format(len(urls)))
+    if args.probe:
+        probe_session(args, session, statuses)
+    if args.resolve_redirects:
+        resolve_session(args, session, statuses)
+
+    total = session.count_urls(statuses)
+    print('Shooting {} URL(s)'.format(total))
 
     if args.dryrun:
-        for u in urls:
+        for u in session.iter_urls(statuses):
             print('Shooting', u)
         return
 
-    if len(urls) == 0:
+    if total == 0:
         return
 
-    with screen.capture.CaptureService(args.node_path, args.proxy, not args.show_browser) as client:
-        client.configure(args.mobile, args.screen_wait_ms, args.page_wait_ms)
-        screen.shoot.capture_from_urls(urls, args.threads, session, client)
+    # by default keep enough warm contexts for every worker sharing a browser
+    context_pool = args.context_pool
+    if context_pool is None:
+        context_pool = (args.threads + args.browsers - 1) // args.browsers
+    services = screen.capture.CaptureServicePool(args.browsers, args.node_path, args.proxy, not args.show_browser, args.unix_socket,
+                                                 context_pool=context_pool, context_max_uses=args.context_max_uses,
+                                                 browser_max_captures=args.browser_recycle,
+                                                 browser_max_rss=args.browser_max_rss_mb * 2**20 if args.browser_max_rss_mb else None)
+    controller = None
+    if args.auto_threads:
+        ceiling = args.threads_max or args.threads * 4
+        controller = screen.concurrency.ConcurrencyController(
+            args.threads_min, ceiling, args.threads,
+            max_rss=args.max_rss_mb * 2**20 if args.max_rss_mb else None, rss=services.rss)
+        print('Auto-tuning concurrency between {} and {}'.format(args.threads_min, ceiling))
+    block = block_profile(args)
+    store = screen.store.ImageStore(args.image_dir)
+    if block:
+        logger.debug('Blocking requests: %s', block)
+    metrics = None
+    if args.metrics_port is not None:
+        metrics = screen.metrics.ScanMetrics(rss=services.rss)
+        metrics.serve(args.metrics_port)
+        session.on_timing = metrics.timing
+    with services as client:
+        # the first pass covers everything. later passes only revisit URLs that timed out in the pass before
+        timeouts = args.timeout_passes or [args.page_wait_ms]
+        started = time.time()
+        urls = session.iter_urls(statuses)
+        for capture_pass, timeout_ms in enumerate(timeouts, start=1):
+            if capture_pass > 1:
+                session.flush()
+                total = session.count_pass_timeouts(capture_pass - 1, started)
+                if total == 0:
+                    break
+                urls = session.iter_pass_timeouts(capture_pass - 1, started)
+            if len(timeouts) > 1:
+                print('Pass {}: shooting {} URL(s) with a {} ms page timeout'.format(capture_pass, total, timeout_ms))
+            client.configure(args.mobile, args.screen_wait_ms, timeout_ms, args.transport, args.adaptive_wait, block,
+                             args.image_format, args.image_quality, args.thumbnail_width, args.views)
+            schedule = screen.schedule.HostScheduler(urls, args.per_host, args.per_ip,
+                                                     args.host_spacing_ms / 1000, max(1000, args.threads * 100))
+            if not screen.shoot.capture_from_urls(schedule, args.threads, session, client, total, capture_pass, controller,
+                                                  store, metrics):
+                break
+    if metrics:
+        # the server thread is a daemon so an exception above cannot leave it running
+        session.on_timing = None
+        metrics.stop()
 
 def handle_report(args):
     template = Template.SingleColumn if args.column else Template.Tiles
-    session = screen.session.WebShooterSession(args.session)
-    name = report.generate.from_session(session, template, args.page_size, args.ignore_errors, args.embed_images)
+    cluster_distance = args.cluster_distance if args.cluster else None
+    if args.single_page and args.embed_images:
+        print('--embed-images is ignored with --single-page')
+    with screen.session.WebShooterSession(args.session) as session:
+        try:
+            if args.single_page:
+                name = report.generate.single_page(session, args.ignore_errors, args.chunk_size, cluster_distance)
+            else:
+                name = report.generate.from_session(session, template, args.page_size, args.ignore_errors,
+                                                    args.embed_images, cluster_distance, args.workers, args.force)
+        except report.cluster.ClusterError as e:
+            print(str(e))
+            return
     if name:
         print('Report generated: '+name)
     else:
         print('Nothing to do')
 
+def handle_stats(args):
+    with screen.session.WebShooterSession(args.session) as session:
+        summary = screen.stats.summarize(session, args.hosts)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print(screen.stats.format_summary(summary))
+
 def run():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(help='Choose an action')
@@ -81,18 +244,85 @@ def run():
     scan_parser.add_argument('-u', '--url-file', action='append', default=[], dest='url_file', help='urls 1 per line. include scheme')
     scan_parser.add_argument('-n', '--node-path', dest='node_path', default=None, help='nodejs path')
     scan_parser.add_argument('-w', '--threads', default=5, type=int, help='number of concurrent screenshots to take. default 5')
+    scan_parser.add_argument('-b', '--browsers', default=1, type=int,
+                             help='number of capture services (node + browser) to spread screenshots over. default 1')
+    scan_parser.add_argument('--auto-threads', dest='auto_threads', action='store_true',
+                             help='adjust concurrent screenshots at runtime based on latency, failures and browser memory. '
+                             '--threads is the starting point')
+    scan_parser.add_argument('--threads-min', dest='threads_min', default=1, type=int, help='floor for --auto-threads. default 1')
+    scan_parser.add_argument('--threads-max', dest='threads_max', default=None, type=int,
+                             help='ceiling for --auto-threads. default 4 x --threads')
+    scan_parser.add_argument('--max-rss', dest='max_rss_mb', default=None, type=int,
+                             help='back off --auto-threads when node and the browsers use more than this many MB')
+    scan_parser.add_argument('--per-host', dest='per_host', default=0, type=int,
+                             help='max concurrent screenshots per host. default 0 (unlimited)')
+    scan_parser.add_argument('--per-ip', dest='per_ip', default=0, type=int,
+                             help='max concurrent screenshots per resolved IP address. default 0 (unlimited)')
+    scan_parser.add_argument('--host-spacing', dest='host_spacing_ms', default=0, type=int,
+                             help='min millisecs between starting screenshots on the same host. default 0')
     scan_parser.add_argument('-t', '--page-timeout', dest='page_wait_ms', default=5000, type=int, help='timeout in millisecs for page load event')
+    scan_parser.add_argument('--timeout-passes', dest='timeout_passes', default=None, type=split_timeouts,
+                             help='comma-separated page timeouts in millisecs, e.g. 3000,10000,30000. the first pass uses the first '
+                             'timeout and each later pass retries only the URLs that timed out in the pass before. overrides --page-timeout')
     scan_parser.add_argument('-l', '--screen-wait', dest='screen_wait_ms', default=2000, type=int, help='wait in millisecs between page load and screenshot')
+    scan_parser.add_argument('--adaptive-wait', dest='adaptive_wait', action='store_true',
+                             help='take the screenshot as soon as the page stops changing. --screen-wait becomes the maximum wait')
+    scan_parser.add_argument('--lean', action='store_true',
+                             help='skip sub-resources that rarely change a screenshot: video, fonts, websockets and common '
+                             'analytics and ad scripts')
+    scan_parser.add_argument('--block-types', dest='block_types', default=[], type=split_resource_types,
+                             help='comma-separated resource types to block, e.g. media,font,script. '
+                             'one of ' + ','.join(screen.capture.RESOURCE_TYPES))
+    scan_parser.add_argument('--block-url', dest='block_urls', default=[], action='append',
+                             help='block requests whose URL matches this glob, e.g. "*://*.example.com/*". may be repeated')
+    scan_parser.add_argument('--block-third-party', dest='block_third_party', action='store_true',
+                             help='block requests to sites other than the one being captured')
+    scan_parser.add_argument('--format', dest='image_format', default=screen.capture.ImageFormat.PNG,
+                             choices=list(screen.capture.ImageFormat.EXTENSIONS), help='screenshot image format. default png')
+    scan_parser.add_argument('--quality', dest='image_quality', default=None, type=int,
+                             help='jpeg or webp quality from 0 to 100. also used for thumbnails')
+    scan_parser.add_argument('--image-dir', dest='image_dir', default=screen.store.DEFAULT_ROOT,
+                             help='directory for screenshots. identical images are stored once. default %(default)s')
+    scan_parser.add_argument('--thumbnail-width', dest='thumbnail_width', default=400, type=int,
+                             help='width in pixels of the thumbnail saved with each screenshot for the report. 0 for none. default 400')
     scan_parser.add_argument('--mobile', action='store_true', help='Emulate mobile device')
+    scan_parser.add_argument('--views', default=[], type=split_views,
+                             help='comma-separated extra screenshots to take from the same page load: desktop, mobile '
+                             'and full (the whole page)')
     scan_parser.add_argument('-r', '--retry', action='store_true', help='retry failed urls')
     scan_parser.add_argument('--ports-http', dest='ports_http', default=DEFAULT_HTTP_PORTS,
                         type=split_ports, help='comma-separated')
     scan_parser.add_argument('--ports-https', dest='ports_https', default=DEFAULT_HTTPS_PORTS,
                         type=split_ports, help='comma-separated')
+    scan_parser.add_argument('--nmap-services', dest='nmap_services', action='store_true',
+                             help='also scan ports where nmap detected an http service, using https if it was tunneled over ssl')
     scan_parser.add_argument('--all-open', dest='all_open', action='store_true', help='scan all open ports')
+    scan_parser.add_argument('--probe', action='store_true',
+                             help='check that each port is open and speaks the right scheme before starting the browser')
+    scan_parser.add_argument('--probe-timeout', dest='probe_timeout_ms', default=3000, type=int,
+                             help='connect and TLS handshake timeout in millisecs for --probe and --resolve-redirects. default 3000')
+    scan_parser.add_argument('--probe-concurrency', dest='probe_concurrency', default=targets.probe.DEFAULT_CONCURRENCY,
+                             type=int, help='concurrent connections for --probe and --resolve-redirects. default %(default)s')
+    scan_parser.add_argument('--resolve-redirects', dest='resolve_redirects', action='store_true',
+                             help='follow HTTP redirects before starting the browser and capture only one URL per final location')
     scan_parser.add_argument('urls', default=[], nargs='*', help='urls including scheme')
     scan_parser.add_argument('--dryrun', action='store_true', help='list URLs to scan')
     scan_parser.add_argument('--proxy', help='proxy for headless browser. e.g. "socks://127.0.0.1:8080"')
+    scan_parser.add_argument('--transport', choices=[screen.capture.Transport.FILE, screen.capture.Transport.INLINE],
+                             default=screen.capture.Transport.FILE,
+                             help='how screenshots get from the browser to disk. "file" has the capture service write them directly. default file')
+    scan_parser.add_argument('--unix-socket', dest='unix_socket', action='store_true',
+                             help='talk to the capture service over a Unix domain socket instead of a local TCP port')
+    scan_parser.add_argument('--context-pool', dest='context_pool', default=None, type=int,
+                             help='warm browser contexts to keep per browser. 0 creates a new context per URL. default threads/browsers')
+    scan_parser.add_argument('--context-reuse', dest='context_max_uses', default=screen.capture.CaptureService.DEFAULT_CONTEXT_MAX_USES,
+                             type=int, help='URLs captured by a browser context before it is recycled. default %(default)s')
+    scan_parser.add_argument('--browser-recycle', dest='browser_recycle', default=0, type=int,
+                             help='replace each browser after this many screenshots. default 0 (never)')
+    scan_parser.add_argument('--metrics-port', dest='metrics_port', default=None, type=int,
+                             help='serve live scan metrics for Prometheus on this local port')
+    scan_parser.add_argument('--browser-max-rss', dest='browser_max_rss_mb', default=None, type=int,
+                             help='replace a browser once it and its capture service use more than this many MB')
     scan_parser.add_argument('--show-browser', dest='show_browser', action='store_true', help='display the browser (*nix only)')
 
     # report
@@ -103,6 +333,22 @@ def run():
     report_parser.add_argument('--column', action='store_true', help='Generate report with single column')
     report_parser.add_argument('-p', '--page-size', dest='page_size', default=8, type=int, help='results per page')
     report_parser.add_argument('--embed-images', dest='embed_images', action='store_true', help='Embed images in HTML as base64')
+    report_parser.add_argument('--workers', default=None, type=int, help='processes rendering pages. default one per CPU')
+    report_parser.add_argument('--force', action='store_true', help='render every page, even ones unchanged since the last report')
+    report_parser.add_argument('--cluster', action='store_true',
+                               help='group visually similar screenshots, biggest groups first. needs numpy and Pillow')
+    report_parser.add_argument('--cluster-distance', dest='cluster_distance', default=report.cluster.DEFAULT_DISTANCE, type=int,
+                               help='how many of 64 image hash bits may differ within a group. default %(default)s')
+    report_parser.add_argument('--single-page', dest='single_page', action='store_true',
+                               help='one scrolling page with filters that loads results from data files. for big sessions')
+    report_parser.add_argument('--chunk-size', dest='chunk_size', default=5000, type=int,
+                               help='results per data file with --single-page. default %(default)s')
+
+    # stats
+    stats_parser = subparsers.add_parser('stats', help='Show where capture time went')
+    stats_parser.set_defaults(handle=handle_stats)
+    stats_parser.add_argument('--hosts', default=10, type=int, help='slowest hosts to list. default %(default)s')
+    stats_parser.add_argument('--json', action='store_true', help='print the summary as JSON')
 
     args = parser.parse_args()
     if args.debug or args.verbose:
@@ -1,2 +1,3 @@
 from . import generate
-from . import template
\ No newline at end of file
+from . import template
+from . import cluster
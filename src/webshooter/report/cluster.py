@@ -0,0 +1,141 @@
+import os
+import logging
+from collections.abc import Iterable
+from typing import Any, Optional
+
+logger = logging.getLogger(__package__)
+
+# max differing bits out of 64 for two screenshots to count as the same page
+DEFAULT_DISTANCE = 6
+# images decoded per batch
+HASH_BATCH_SIZE = 256
+# elements in one block of pairwise comparisons. bounds memory for huge buckets
+COMPARE_BLOCK = 2**22
+
+class ClusterError(Exception):
+    pass
+
+def _require():
+    ''' numpy and Pillow are only needed for clustering. import them on first use '''
+    try:
+        import numpy
+        from PIL import Image
+    except ImportError as e:
+        raise ClusterError('clustering needs numpy and Pillow. install them with "pip install webshooter[cluster]": '
+                           + str(e))
+    return numpy, Image
+
+def _load(Image, path: str, size: tuple[int, int]) -> Optional[Any]:
+    try:
+        with Image.open(path) as img:
+            # let the JPEG decoder skip most of the work. the image is shrunk to a few pixels anyway
+            img.draft('L', (size[0] * 8, size[1] * 8))
+            return img.convert('L').resize(size, Image.BILINEAR)
+    except (OSError, ValueError) as e:
+        logger.warning('Failed to hash %s: %s', path, str(e))
+        return None
+
+def dhash(paths: list[str]) -> list[Optional[int]]:
+    '''
+    64-bit difference hash of each image: shrink to 9x8 grey pixels and set a bit wherever a pixel
+    is brighter than its left neighbour. Similar images get hashes a few bits apart. None for
+    images that cannot be read.
+    '''
+    np, Image = _require()
+    hashes = [None] * len(paths)
+    for start in range(0, len(paths), HASH_BATCH_SIZE):
+        images = []
+        index = []
+        for i, path in enumerate(paths[start:start+HASH_BATCH_SIZE], start=start):
+            img = _load(Image, path, (9, 8))
+            if img is not None:
+                images.append(np.asarray(img, dtype=np.int16))
+                index.append(i)
+        if len(images) == 0:
+            continue
+        pixels = np.stack(images)
+        bits = pixels[:, :, 1:] > pixels[:, :, :-1]
+        packed = np.packbits(bits.reshape(len(images), 64), axis=1)
+        for i, value in zip(index, packed.view('>u8').ravel()):
+            hashes[i] = int(value)
+    return hashes
+
+def _popcount(np, x):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return np.unpackbits(x.view(np.uint8).reshape(x.shape + (8,)), axis=-1).sum(axis=-1)
+
+def _find(parent: list[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def cluster_hashes(hashes: Iterable[int], distance: int=DEFAULT_DISTANCE) -> dict[int, int]:
+    '''
+    Group 64-bit hashes that are within `distance` bits of each other, directly or through a chain
+    of close hashes. Returns a cluster id for each distinct hash.
+
+    Hashes are split into `distance + 1` bands. Two hashes within `distance` bits must agree on at
+    least one whole band, so only hashes that share a band value are ever compared.
+    '''
+    np, _ = _require()
+    values = np.unique(np.fromiter(hashes, dtype=np.uint64))
+    n = len(values)
+    parent = list(range(n))
+    bands = min(distance + 1, 64)
+    offset = 0
+    for b in range(bands):
+        width = 64 // bands + (1 if b < 64 % bands else 0)
+        keys = (values >> np.uint64(offset)) & np.uint64((1 << width) - 1)
+        offset += width
+        order = np.argsort(keys, kind='stable')
+        bounds = np.flatnonzero(np.diff(keys[order])) + 1
+        for bucket in np.split(order, bounds):
+            if len(bucket) < 2:
+                continue
+            members = values[bucket]
+            rows = max(1, COMPARE_BLOCK // len(bucket))
+            for start in range(0, len(bucket), rows):
+                d = _popcount(np, members[start:start+rows, None] ^ members[None, :])
+                for i, j in zip(*np.nonzero(d <= distance)):
+                    i = int(bucket[start + i])
+                    j = int(bucket[j])
+                    if i < j:
+                        ri, rj = _find(parent, i), _find(parent, j)
+                        if ri != rj:
+                            parent[max(ri, rj)] = min(ri, rj)
+    return {int(values[i]): _find(parent, i) for i in range(n)}
+
+def hash_session(session):
+    ''' compute and store hashes for screenshots that do not have one yet '''
+    images = session.get_unhashed_images()
+    if len(images) == 0:
+        return
+    logger.info('Hashing %d screenshot(s)', len(images))
+    for start in range(0, len(images), HASH_BATCH_SIZE):
+        batch = images[start:start+HASH_BATCH_SIZE]
+        # thumbnails decode much faster and hash the same
+        paths = [thumbnail if thumbnail and os.path.exists(thumbnail) else image for image, thumbnail in batch]
+        hashes = dhash(paths)
+        session.set_image_hashes([(image, '{:016x}'.format(h)) for (image, _), h in zip(batch, hashes) if h is not None])
+
+def group_results(results: list[dict[str, Any]], distance: int=DEFAULT_DISTANCE, key=None) -> list[dict[str, Any]]:
+    '''
+    Collapse `results` into one entry per visual cluster. Each entry is the first member by `key`
+    with the others under 'similar'. Bigger clusters come first. Results without a hash stand alone.
+    '''
+    hashed = [r for r in results if r.get('phash')]
+    clusters = cluster_hashes((int(r['phash'], 16) for r in hashed), distance) if hashed else {}
+    groups: dict[Any, list[dict[str, Any]]] = {}
+    for i, r in enumerate(results):
+        group = ('phash', clusters[int(r['phash'], 16)]) if r.get('phash') else ('result', i)
+        groups.setdefault(group, []).append(r)
+    collapsed = []
+    for members in groups.values():
+        members.sort(key=key)
+        rep = members[0]
+        rep['similar'] = members[1:]
+        collapsed.append(rep)
+    collapsed.sort(key=lambda r: (-len(r['similar']), key(r) if key else 0))
+    return collapsed
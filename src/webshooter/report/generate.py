@@ -1,7 +1,11 @@
 import os
+import json
 import base64
+import hashlib
 import shutil
+import functools
 import logging
+import concurrent.futures
 from collections import deque
 
 from webshooter import report
@@ -27,44 +31,197 @@ def server_sort(x):
 def all_sort(x):
     return title_sort(x) if x['title'] else server_sort(x)
 
+MIME_TYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.jpeg': 'image/jpeg', '.webp': 'image/webp'}
+
+@functools.lru_cache(maxsize=256)
+def data_uri(image_file):
+    # cached so an image shared by many screens is only read and encoded once
+    mime = MIME_TYPES.get(os.path.splitext(image_file)[1].lower(), 'image/png')
+    return 'data:{};base64,'.format(mime) + base64.b64encode(open(image_file, 'rb').read()).decode()
+
 def get_index(r):
     return r['title'].lower() if r['title'] else r['server'].lower()
 
-def from_session(session, template, page_size, ignore_errors=False, embed_images=False):
+def embed(screens):
+    for s in screens:
+        image = s['image']
+        s['image'] = data_uri(image)
+        s['thumbnail'] = data_uri(s['thumbnail']) if s['thumbnail'] != image else s['image']
+        s['views'] = {name: data_uri(v) for name, v in s.get('views', {}).items()}
+        for similar in s.get('similar', []):
+            similar['image'] = data_uri(similar['image'])
+
+def render_page(path, template, title, screens, pages_index, pageno, page_prev, page_next, pages, embed_images):
+    ''' runs in a worker process '''
+    if embed_images:
+        embed(screens)
+    page = report.template.populate(template, title, screens, None, pages_index, pageno, page_prev, page_next, pages)
+    with open(path, 'w') as fp:
+        fp.write(page)
+    return path
+
+MANIFEST = 'report.manifest.json'
+
+def load_manifest() -> dict:
+    try:
+        with open(MANIFEST) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+def templates_digest() -> str:
+    ''' pages are rendered again when a template changes '''
+    h = hashlib.sha256()
+    templates = os.path.join(os.path.dirname(__file__), 'templates')
+    for name in sorted(os.listdir(templates)):
+        with open(os.path.join(templates, name), 'rb') as fp:
+            h.update(name.encode() + b'\0' + fp.read())
+    return h.hexdigest()
+
+def page_digest(*args) -> str:
+    return hashlib.sha256(json.dumps(args, sort_keys=True, default=list).encode()).hexdigest()
+
+def page_chunks(results, page_size):
+    page = []
+    for r in results:
+        page.append(r)
+        if len(page) == page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+def from_session(session, template, page_size, ignore_errors=False, embed_images=False, cluster_distance=None,
+                 workers=None, force=False):
     ''' {'url': url, 'url_final', url, 'title': page_title, 'server': server_header, 'status': status_code,
-    'image': file} '''
-    results = session.get_results(ignore_errors)
-    if len(results) == 0:
+    'image': file, 'thumbnail': file, 'views': {name: file}, 'similar': [result]}
+
+    Results are streamed from the session a page at a time and pages are rendered by `workers`
+    processes. A manifest of what went into each page lets later runs skip pages that have not
+    changed, unless `force` is set.
+
+    With `cluster_distance`, visually similar screenshots are collapsed under one result and the
+    biggest clusters come first. Clustering needs every result in memory.
+    '''
+    if cluster_distance is not None:
+        report.cluster.hash_session(session)
+        results = report.cluster.group_results(session.get_results(ignore_errors), cluster_distance, all_sort)
+        count = len(results)
+        logger.info('Found {} visual cluster(s)'.format(count))
+    else:
+        count = session.count_results(ignore_errors)
+        results = session.iter_results(ignore_errors)
+    if count == 0:
         return None
-    logger.info('Generating report: {} screenshot(s)'.format(len(results)))
-    results = list(sorted(results, key=all_sort))
-    page_count = (len(results) + page_size - 1) // page_size
+    logger.info('Generating report: {} screenshot(s)'.format(count))
+    page_count = (count + page_size - 1) // page_size
     pages = ['page.{}.html'.format(i) for i in range(page_count)]
-    last_index = get_index(results[0])
+
+    old_manifest = load_manifest()
+    manifest = {}
+    version = templates_digest()
+    last_index = None
     index_list = []
-    for i, pageno in zip(range(0, len(results), page_size), range(len(pages))):
-        # build index that maps each unique page title/server to the first occurence
-        for j, r in enumerate(results[i:i+page_size]):
-            index = get_index(r)
-            if index != last_index:
-                last_index = index
-                href = '{}#result-id-{}'.format(pages[pageno], i+j)
-                index_list.append([index, href, pageno])
-        # pageno is zero based
-        page_prev = pages[(pageno+len(pages)-1) % len(pages)]
-        page_next = pages[(pageno+1) % len(pages)]
-        screens = results[i:i+page_size]
-        for j, s in enumerate(screens):
-            s['id'] = 'result-id-{}'.format(pageno * page_size + j)
-            if embed_images:
-                s['image'] = 'data:image/png;base64,'+base64.b64encode(open(s['image'], 'rb').read()).decode()
-        pages_index = deque([{'href': p, 'number':i} for i, p in enumerate(pages)])
-        # center active page
-        pages_index.rotate(len(pages)//2 - pageno)
-        page = report.template.populate(template, 'Page {}'.format(pageno), screens, len(results),
-                                        pages_index, pageno, page_prev, page_next, pages)
-        logger.info('Generating {}'.format(pages[pageno]))
-        open(pages[pageno], 'w').write(page)
+    skipped = 0
+    workers = workers or os.cpu_count() or 1
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        rendering = set()
+        for pageno, screens in enumerate(page_chunks(results, page_size)):
+            i = pageno * page_size
+            # build index that maps each unique page title/server to the first occurence
+            for j, r in enumerate(screens):
+                index = get_index(r)
+                if index != last_index:
+                    last_index = index
+                    href = '{}#result-id-{}'.format(pages[pageno], i+j)
+                    index_list.append([index, href, pageno])
+            # pageno is zero based
+            page_prev = pages[(pageno+len(pages)-1) % len(pages)]
+            page_next = pages[(pageno+1) % len(pages)]
+            for j, s in enumerate(screens):
+                s['id'] = 'result-id-{}'.format(i + j)
+                # tiles show the thumbnail. the full image is only loaded when opened
+                s['thumbnail'] = s.get('thumbnail') or s['image']
+            pages_index = deque([{'href': p, 'number':i} for i, p in enumerate(pages)])
+            # center active page
+            pages_index.rotate(len(pages)//2 - pageno)
+            title = 'Page {}'.format(pageno)
+            path = pages[pageno]
+            digest = page_digest(version, template, embed_images, title, screens, pageno, len(pages))
+            manifest[path] = digest
+            if not force and old_manifest.get(path) == digest and os.path.exists(path):
+                skipped += 1
+                continue
+            logger.info('Generating {}'.format(path))
+            rendering.add(pool.submit(render_page, path, template, title, screens, list(pages_index), pageno,
+                                      page_prev, page_next, pages, embed_images))
+            if len(rendering) >= workers * 2:
+                # keep only a few pages in memory
+                done, rendering = concurrent.futures.wait(rendering, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    f.result()
+        for f in concurrent.futures.as_completed(rendering):
+            f.result()
+    if skipped:
+        logger.info('{} page(s) unchanged since the last report'.format(skipped))
+    # pages left over from a bigger report
+    for path in set(old_manifest) - set(manifest):
+        if os.path.exists(path):
+            os.remove(path)
     open('index.html', 'w').write(report.template.populate_index(report.template.Template.Index, index_list))
+    with open(MANIFEST, 'w') as fp:
+        json.dump(manifest, fp)
     copy_files()
     return pages[0]
+
+SINGLE_PAGE = 'report.html'
+DATA_DIR = 'data'
+# columns of each result row in the data files
+SINGLE_FIELDS = ['url', 'url_final', 'title', 'server', 'status', 'image', 'thumbnail', 'views', 'shared', 'headers',
+                 'similar']
+
+def chunk_name(n):
+    return '{}/results.{}.js'.format(DATA_DIR, n)
+
+def single_row(r):
+    r['thumbnail'] = r.get('thumbnail') or r['image']
+    # the page only needs to know where the similar results are
+    r['similar'] = [s['url_final'] for s in r.get('similar', [])]
+    return [r.get(f) for f in SINGLE_FIELDS]
+
+def single_page(session, ignore_errors=False, chunk_size=5000, cluster_distance=None):
+    '''
+    Generate one page that loads results from data files of `chunk_size` rows each and only builds
+    the tiles in view. Data files are JSON wrapped in a function call so the report works from
+    file:// where browsers refuse to fetch local files.
+    '''
+    if cluster_distance is not None:
+        report.cluster.hash_session(session)
+        results = report.cluster.group_results(session.get_results(ignore_errors), cluster_distance, all_sort)
+        logger.info('Found {} visual cluster(s)'.format(len(results)))
+    else:
+        results = session.iter_results(ignore_errors)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    count = 0
+    chunks = []
+    for n, rows in enumerate(page_chunks(results, chunk_size)):
+        chunks.append(chunk_name(n))
+        logger.info('Generating {}'.format(chunks[-1]))
+        with open(chunks[-1], 'w') as fp:
+            fp.write('webshooterChunk(')
+            json.dump([single_row(r) for r in rows], fp, separators=(',', ':'))
+            fp.write(');\n')
+        count += len(rows)
+    # chunks left over from a bigger report
+    n = len(chunks)
+    while os.path.exists(chunk_name(n)):
+        os.remove(chunk_name(n))
+        n += 1
+    if count == 0:
+        return None
+    logger.info('Generated report: {} screenshot(s)'.format(count))
+    meta = {'count': count, 'fields': SINGLE_FIELDS, 'chunks': chunks}
+    with open(SINGLE_PAGE, 'w') as fp:
+        fp.write(report.template.populate_single(report.template.Template.Single, meta))
+    copy_files()
+    return SINGLE_PAGE
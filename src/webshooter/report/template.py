@@ -12,6 +12,7 @@ class Template:
     SingleColumn = 'page.html'
     Tiles = 'card.html'
     Index = 'index.html'
+    Single = 'single.html'
 
 def populate(template, title, screens, count, pages_index, pageno, page_prev, page_next, pages):
     t = env.get_template(template)
@@ -28,3 +29,7 @@ def populate(template, title, screens, count, pages_index, pageno, page_prev, pa
 def populate_index(template, index):
     t = env.get_template(template)
     return t.render(index=index, title='Report Index')
+
+def populate_single(template, report):
+    t = env.get_template(template)
+    return t.render(report=report, title='Report')
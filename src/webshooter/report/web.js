@@ -1,9 +1,10 @@
 document.onkeydown = function (e) {
     e = e || window.event;
-    if (e.keyCode == '37') { //left
+    // the single page report has no pages
+    if (e.keyCode == '37' && document.getElementById('prev-page')) { //left
         document.getElementById('prev-page').click();
     }
-    else if (e.keyCode == '39') { //right
+    else if (e.keyCode == '39' && document.getElementById('next-page')) { //right
         document.getElementById('next-page').click();
     }
 }
@@ -56,4 +57,251 @@ function centerNav () {
 
     //var bottom = document.getElementById('nav-bottom');
     //bottom.scrollLeft = scroll;
-}
\ No newline at end of file
+}
+
+/*
+Single page report. Results arrive in chunks of rows from script files so the report also works
+when opened from file://. Only the tiles near the viewport exist at any time and their images are
+loaded when they come into view.
+*/
+var report = {
+    results: [],
+    filtered: [],
+    fields: {},
+    nextChunk: 0,
+    columns: 1,
+    rendered: {},
+    observer: null,
+    filterTimer: null
+};
+
+var TILE_WIDTH = 360;
+var ROW_HEIGHT = 360;
+// rows rendered above and below the viewport
+var OVERSCAN = 2;
+
+function startReport () {
+    for (var i = 0; i < webshooterReport.fields.length; i++) {
+        report.fields[webshooterReport.fields[i]] = i;
+    }
+    if ('IntersectionObserver' in window) {
+        report.observer = new IntersectionObserver(loadVisibleImages, {rootMargin: '200px'});
+    }
+    window.addEventListener('scroll', renderVisible, {passive: true});
+    window.addEventListener('resize', function () { clearRendered(); layout(); });
+    layout();
+    loadNextChunk();
+}
+
+function loadNextChunk () {
+    if (report.nextChunk >= webshooterReport.chunks.length) {
+        return;
+    }
+    var script = document.createElement('script');
+    script.src = webshooterReport.chunks[report.nextChunk++];
+    document.body.appendChild(script);
+}
+
+// called by each data file
+function webshooterChunk (rows) {
+    var start = report.results.length;
+    for (var i = 0; i < rows.length; i++) {
+        report.results.push(rows[i]);
+    }
+    // filter only the new rows so loading stays linear
+    var matches = filterRows(start);
+    for (var i = 0; i < matches.length; i++) {
+        report.filtered.push(matches[i]);
+    }
+    layout();
+    loadNextChunk();
+}
+
+function field (row, name) {
+    return row[report.fields[name]];
+}
+
+function searchText (row) {
+    // cached on the row after the last field
+    var n = webshooterReport.fields.length;
+    if (row.length <= n) {
+        row[n] = [field(row, 'title'), field(row, 'server'), field(row, 'url_final'), field(row, 'url')].join(' ').toLowerCase();
+    }
+    return row[n];
+}
+
+function filterRows (start) {
+    var text = document.getElementById('filter-text').value.trim().toLowerCase();
+    var status = document.getElementById('filter-status').value;
+    var matches = [];
+    for (var i = start; i < report.results.length; i++) {
+        var row = report.results[i];
+        if (status && String(field(row, 'status')).charAt(0) != status) {
+            continue;
+        }
+        if (text && searchText(row).indexOf(text) < 0) {
+            continue;
+        }
+        matches.push(row);
+    }
+    return matches;
+}
+
+function filterSoon () {
+    clearTimeout(report.filterTimer);
+    report.filterTimer = setTimeout(applyFilters, 150);
+}
+
+function applyFilters () {
+    report.filtered = filterRows(0);
+    clearRendered();
+    window.scrollTo(0, 0);
+    layout();
+}
+
+function clearRendered () {
+    var container = document.getElementById('results');
+    for (var i in report.rendered) {
+        container.removeChild(report.rendered[i]);
+    }
+    report.rendered = {};
+}
+
+function layout () {
+    var container = document.getElementById('results');
+    var columns = Math.max(1, Math.floor(container.clientWidth / TILE_WIDTH));
+    if (columns != report.columns) {
+        report.columns = columns;
+        clearRendered();
+    }
+    container.style.height = (Math.ceil(report.filtered.length / columns) * ROW_HEIGHT) + 'px';
+    var loading = report.nextChunk < webshooterReport.chunks.length ? ' (loading)' : '';
+    document.getElementById('result-count').textContent =
+        report.filtered.length + ' of ' + webshooterReport.count + ' result(s)' + loading;
+    renderVisible();
+}
+
+function renderVisible () {
+    var container = document.getElementById('results');
+    var top = container.getBoundingClientRect().top;
+    var firstRow = Math.max(0, Math.floor(-top / ROW_HEIGHT) - OVERSCAN);
+    var lastRow = Math.ceil((window.innerHeight - top) / ROW_HEIGHT) + OVERSCAN;
+    var first = firstRow * report.columns;
+    var last = Math.min(report.filtered.length, (lastRow + 1) * report.columns);
+    for (var i in report.rendered) {
+        if (i < first || i >= last) {
+            container.removeChild(report.rendered[i]);
+            delete report.rendered[i];
+        }
+    }
+    for (var i = first; i < last; i++) {
+        if (!(i in report.rendered)) {
+            report.rendered[i] = buildTile(report.filtered[i], i);
+            container.appendChild(report.rendered[i]);
+        }
+    }
+}
+
+function loadVisibleImages (entries) {
+    for (var i = 0; i < entries.length; i++) {
+        if (entries[i].isIntersecting) {
+            var img = entries[i].target;
+            img.src = img.dataset.src;
+            report.observer.unobserve(img);
+        }
+    }
+}
+
+function openModal (title, image) {
+    showModal({preventDefault: function () {}, data: {title: title, image: image}});
+}
+
+function element (tag, className, text) {
+    var e = document.createElement(tag);
+    if (className) {
+        e.className = className;
+    }
+    if (typeof text !== 'undefined') {
+        e.textContent = text;
+    }
+    return e;
+}
+
+function safeLink (url) {
+    // titles and URLs come from scanned sites. only link plain web URLs
+    var a = element('a', '', url);
+    if (/^https?:\/\//i.test(url)) {
+        a.href = url;
+        a.target = '_blank';
+        a.rel = 'noopener noreferrer';
+    }
+    return a;
+}
+
+function labelled (label, value) {
+    var h = element('h6', 'text-truncate');
+    h.appendChild(element('b', '', label));
+    h.appendChild(document.createTextNode(': ' + value));
+    return h;
+}
+
+function buildTile (row, i) {
+    var title = field(row, 'title');
+    var image = field(row, 'image');
+    var tile = element('div', 'card p-1 border border-secondary virtual-tile');
+    tile.style.width = TILE_WIDTH + 'px';
+    tile.style.height = ROW_HEIGHT + 'px';
+    tile.style.left = ((i % report.columns) * TILE_WIDTH) + 'px';
+    tile.style.top = (Math.floor(i / report.columns) * ROW_HEIGHT) + 'px';
+
+    var a = element('a');
+    a.href = image;
+    a.onclick = function (e) { e.preventDefault(); openModal(title, image); };
+    var img = element('img', 'card-img-top border border-primary');
+    var thumbnail = field(row, 'thumbnail') || image;
+    if (report.observer) {
+        img.dataset.src = thumbnail;
+        report.observer.observe(img);
+    } else {
+        img.src = thumbnail;
+    }
+    a.appendChild(img);
+    tile.appendChild(a);
+
+    var info = element('div', 'py-1 bg-lite virtual-info');
+    var link = element('h6', 'text-truncate');
+    link.appendChild(safeLink(field(row, 'url_final')));
+    info.appendChild(link);
+    info.appendChild(labelled('Title', title));
+    info.appendChild(labelled('Server', field(row, 'server')));
+    info.appendChild(labelled('Status', field(row, 'status')));
+    var original = labelled('Original Url', '');
+    original.appendChild(safeLink(field(row, 'url')));
+    info.appendChild(original);
+    if (field(row, 'shared') > 1) {
+        info.appendChild(element('span', 'badge badge-info mr-1', field(row, 'shared') + ' hosts share this screenshot'));
+    }
+    var views = field(row, 'views') || {};
+    for (var name in views) {
+        (function (name, view) {
+            var b = element('button', 'btn btn-sm btn-outline-secondary mr-1', name);
+            b.onclick = function () { openModal(title + ' (' + name + ')', view); };
+            info.appendChild(b);
+        })(name, views[name]);
+    }
+    var similar = field(row, 'similar') || [];
+    if (similar.length > 0) {
+        info.appendChild(element('span', 'badge badge-secondary', similar.length + ' similar'));
+    }
+    var headers = element('div', 'virtual-headers');
+    var button = element('button', 'collapsible btn btn-primary btn-sm', 'Headers');
+    button.onclick = function () { toggleHeader(headers); };
+    info.appendChild(button);
+    var rows = field(row, 'headers') || [];
+    for (var j = 0; j < rows.length; j++) {
+        headers.appendChild(labelled(rows[j][0], rows[j][1]));
+    }
+    info.appendChild(headers);
+    tile.appendChild(info);
+    return tile;
+}
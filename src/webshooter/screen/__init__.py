@@ -1,3 +1,9 @@
 from . import capture
 from . import session
-from . import shoot
\ No newline at end of file
+from . import procstat
+from . import concurrency
+from . import schedule
+from . import store
+from . import stats
+from . import metrics
+from . import shoot
@@ -3,24 +3,86 @@ import sys
 import json
 import time
 import math
+import base64
+import hashlib
 import shutil
+import queue
+import socket
 import logging
 import tempfile
+import threading
 import subprocess
-import urllib.error
-import urllib.request
+import http.client
+import urllib.parse
 from binascii import hexlify
-from typing import Any, TypedDict
+from typing import Any, Optional, TypedDict
 
-from webshooter.screen.session import Status, WebShooterSession
+from webshooter.screen.session import Status, Stage, WebShooterSession
+from webshooter.screen.procstat import tree_rss
 
 logger = logging.getLogger(__package__)
 
 class CaptureError(Exception):
+    '''
+    `details` is the error reported by the capture service, if any. `timings` holds milliseconds
+    per Stage for as far as the capture got
+    '''
     def __init__(self, message):
+        self.details = message if isinstance(message, dict) else {}
         if isinstance(message, dict):
             message = message.get('message', str(message))
         super().__init__(message)
+        self.timings: dict[str, int] = dict(self.details.get('timings') or {})
+    @property
+    def name(self) -> str:
+        ''' error name from the capture service, e.g. TimeoutError, else the exception class '''
+        return self.details.get('name') or type(self).__name__
+
+class CaptureTimeout(CaptureError):
+    ''' the page did not load in time '''
+
+class CaptureUnavailable(CaptureError):
+    ''' the capture service or its browser went away. the URL should be tried again later '''
+
+class BlockProfile(TypedDict):
+    # puppeteer resource types, e.g. media, font, websocket
+    types: list[str]
+    # URL globs where * matches anything
+    patterns: list[str]
+    # requests to a different site than the page
+    third_party: bool
+
+# resource types that can be blocked. 'document' only matches frames, never the page itself
+RESOURCE_TYPES = ['document', 'stylesheet', 'image', 'media', 'font', 'script', 'texttrack', 'xhr', 'fetch', 'prefetch',
+                  'eventsource', 'websocket', 'manifest', 'ping', 'other']
+# sub-resources that rarely change what a triage screenshot shows
+LEAN_PROFILE: BlockProfile = {
+    'types': ['media', 'font', 'texttrack', 'prefetch', 'eventsource', 'websocket', 'manifest', 'ping'],
+    'patterns': [
+        '*://*.google-analytics.com/*', '*://*.googletagmanager.com/*', '*://*.doubleclick.net/*',
+        '*://*.googlesyndication.com/*', '*://*.facebook.net/*', '*://*.hotjar.com/*', '*://*.segment.io/*',
+        '*://*.newrelic.com/*', '*://*.nr-data.net/*', '*://*.scorecardresearch.com/*'
+    ],
+    'third_party': False
+}
+
+class ImageFormat:
+    PNG='png'
+    JPEG='jpeg'
+    WEBP='webp'
+    EXTENSIONS = {PNG: '.png', JPEG: '.jpg', WEBP: '.webp'}
+    @staticmethod
+    def thumbnail(image_format: str) -> str:
+        ''' format used for thumbnails. lossless thumbnails are not worth the bytes '''
+        return ImageFormat.JPEG if image_format == ImageFormat.PNG else image_format
+
+class View:
+    ''' extra screenshots taken from the same page load '''
+    DESKTOP='desktop'
+    MOBILE='mobile'
+    # the whole page at the viewport of the main screenshot
+    FULL='full'
+    ALL = [DESKTOP, MOBILE, FULL]
 
 class CaptureRequest(TypedDict):
     url: str
@@ -28,6 +90,38 @@ class CaptureRequest(TypedDict):
     render_wait_ms: int
     timeout_ms: int
     headers: dict[str, str]
+    # if set, the service writes the screenshot here instead of returning it in the response
+    image_path: str
+    # treat render_wait_ms as a cap and take the screenshot once the page is visually stable
+    adaptive_wait: bool
+    # sub-resources to abort. None loads everything
+    block: Optional[BlockProfile]
+    # ImageFormat for the screenshot. quality (0-100) only applies to jpeg and webp
+    image_format: str
+    image_quality: Optional[int]
+    # also render a thumbnail this many pixels wide. 0 for none
+    thumbnail_width: int
+    thumbnail_path: str
+    # View names to capture after the main screenshot, and where to write each
+    views: list[str]
+    view_paths: dict[str, str]
+
+class CaptureView(TypedDict):
+    name: str
+    # base64 image. empty when it was written to `image_path`
+    image: str
+    image_path: str
+    image_size: int
+    image_sha256: str
+
+class RequestCounters(TypedDict):
+    # sub-resource requests let through
+    requests: int
+    blocked: int
+    # blocked requests by resource type, 'pattern' or 'third_party'
+    blocked_by: dict[str, int]
+    # sum of content-length over loaded responses. the size of blocked requests is unknowable
+    bytes_received: int
 
 class CaptureResponse(TypedDict):
     # URL after following redirects
@@ -38,9 +132,112 @@ class CaptureResponse(TypedDict):
     headers: dict[str, str]
     # HTTP response status
     status: int
-    # base64 PNG
+    # base64 PNG. empty when the image was written to `image_path`
     image: str
+    image_path: str
+    image_size: int
+    # hex SHA-256 of the image bytes
+    image_sha256: str
+    # base64 thumbnail. empty when it was written to `thumbnail_path` or none was asked for
+    thumbnail: str
+    thumbnail_path: str
+    thumbnail_size: int
+    views: list[CaptureView]
+    # how long the service actually waited for the page to render
+    render_wait_ms: int
+    # page load timeout used for this capture
+    timeout_ms: int
+    # true if the load event never fired and the screenshot was taken after domcontentloaded
+    load_fallback: bool
+    requests: RequestCounters
     security: dict[Any, Any]
+    # milliseconds per Stage
+    timings: dict[str, int]
+
+def find_free_port(host: str='127.0.0.1') -> int:
+    ''' ask the OS for an unused TCP port. the port is released before returning so there is a
+        small window where another process could claim it
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    ''' HTTP connection over a Unix domain socket '''
+    def __init__(self, socket_path: str, timeout: float=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class ConnectionPool():
+    '''
+    Persistent HTTP/1.1 connections to the capture service. Connections are created on demand and
+    up to `max_idle` of them are kept open between requests. `endpoint` is either
+    http://host:port or unix:/path/to/socket.
+    '''
+    # errors that mean a kept-alive connection went stale before we got a response
+    STALE_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+    def __init__(self, endpoint: str, max_idle: int=64):
+        if endpoint.startswith('unix:'):
+            self.socket_path = endpoint[len('unix:'):]
+            self.host = self.port = None
+        else:
+            u = urllib.parse.urlparse(endpoint)
+            self.socket_path = None
+            self.host = u.hostname
+            self.port = u.port
+        self.idle = queue.LifoQueue(maxsize=max_idle)
+    def _connect(self, timeout: float) -> http.client.HTTPConnection:
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+    def _get(self, timeout: float) -> tuple[http.client.HTTPConnection, bool]:
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            return self._connect(timeout), False
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn, True
+    def _put(self, conn: http.client.HTTPConnection):
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+    def request(self, method: str, path: str, body: bytes, headers: dict[str, str], timeout: float) -> tuple[int, bytes]:
+        conn, reused = self._get(timeout)
+        while True:
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except self.STALE_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                # the service closed an idle connection. nothing was processed so it is safe to resend
+                logger.debug('Reconnecting to capture service')
+                conn, reused = self._connect(timeout), False
+                continue
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put(conn)
+            return resp.status, data
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
 
 class CaptureService():
     '''
@@ -49,7 +246,22 @@ class CaptureService():
     '''
     CAPTURE_SERVICE_FILE=os.path.join(os.path.dirname(__file__), 'capture_service.js')
     PKG_NODE_ROOT_PATH=os.path.join(os.path.dirname(__file__), 'nodejs')
-    def __init__(self, node_path: str, proxy: str=None, headless: bool=True):
+    DEFAULT_CONTEXT_MAX_USES=20
+    WATCHDOG_INTERVAL_S=5
+    # consecutive failed status checks before a running service is considered hung
+    WATCHDOG_MAX_FAILURES=3
+    # least time between two browser recycles for memory
+    RECYCLE_COOLDOWN_S=60
+    def __init__(self, node_path: str, proxy: str=None, headless: bool=True, port: int=None, unix_socket: bool=False,
+                 context_pool: int=0, context_max_uses: int=DEFAULT_CONTEXT_MAX_USES,
+                 browser_max_captures: int=0, browser_max_rss: int=None):
+        '''
+        `context_pool` is how many warm browser contexts the service keeps between captures. Each
+        context is reset after a capture and recycled after `context_max_uses` captures.
+
+        The browser is replaced after `browser_max_captures` captures (0 for never) or once node and
+        the browser use more than `browser_max_rss` bytes. A service that dies or hangs is restarted.
+        '''
         if not node_path:
             if os.path.isdir(self.PKG_NODE_ROOT_PATH):
                 windows_path = os.path.join(self.PKG_NODE_ROOT_PATH, 'node.exe')
@@ -67,37 +279,66 @@ class CaptureService():
         self.node_path = node_path
         self.proc = None
         self.host = '127.0.0.1'
-        self.port = 3000
-        self.endpoint = f'http://{self.host}:{self.port}'
         self.token = hexlify(os.urandom(16)).decode('ascii')
+        self.socket_path = None
+        if unix_socket:
+            if not hasattr(socket, 'AF_UNIX'):
+                raise RuntimeError('Unix domain sockets are not supported on this platform')
+            self.port = None
+            self.socket_path = os.path.join(tempfile.gettempdir(), 'webshooter-{}.sock'.format(self.token[:16]))
+            self.endpoint = 'unix:' + self.socket_path
+        else:
+            self.port = port or find_free_port(self.host)
+            self.endpoint = f'http://{self.host}:{self.port}'
         self.client = CaptureClient(self.token, self.endpoint)
         self.proxy = proxy
         self.headless = headless
+        self.context_pool = context_pool
+        self.context_max_uses = context_max_uses
+        self.browser_max_captures = browser_max_captures
+        self.browser_max_rss = browser_max_rss
         self.temp_dir = None
+        self.watchdog = None
+        self.watchdog_stop = threading.Event()
+        self.restarts = 0
     def __enter__(self) -> 'CaptureClient':
-        self.temp_dir = tempfile.TemporaryDirectory(prefix='webshooter-')
-        logger.debug('using temp dir %s', self.temp_dir.name)
+        self.create_temp_dir()
         self.start()
         return self.client
     def __exit__(self, type, value, traceback):
         self.shutdown()
+        self.cleanup_temp_dir()
+    def create_temp_dir(self):
+        self.temp_dir = tempfile.TemporaryDirectory(prefix='webshooter-')
+        logger.debug('using temp dir %s', self.temp_dir.name)
+    def cleanup_temp_dir(self):
         if self.temp_dir:
             try:
                 self.temp_dir.cleanup()
             except Exception as err:
                 logger.error('Failed to cleanup temp dir: %s', str(err))
+            self.temp_dir = None
     def start(self):
+        self.launch()
+        self.wait_ready()
+    def launch(self):
         # Node wouldn't work correctly on Windows without pulling in most of the environment
         env = dict(os.environ)
         env.update({
             # This sets the Chromium user data directory
             # see https://chromium.googlesource.com/chromium/src/+/HEAD/docs/user_data_dir.md
             'WEBSHOOTER_TEMP': self.temp_dir.name,
-            'WEBSHOOTER_PORT': str(self.port),
             'WEBSHOOTER_TOKEN': self.token,
             'WEBSHOOTER_DOCKER': os.environ.get('WEBSHOOTER_DOCKER', 'no'),
-            'WEBSHOOTER_HEADLESS': 'yes' if self.headless else 'no'
+            'WEBSHOOTER_HEADLESS': 'yes' if self.headless else 'no',
+            'WEBSHOOTER_POOL_SIZE': str(self.context_pool),
+            'WEBSHOOTER_POOL_MAX_USES': str(self.context_max_uses),
+            'WEBSHOOTER_BROWSER_MAX_CAPTURES': str(self.browser_max_captures)
         })
+        if self.socket_path:
+            env['WEBSHOOTER_SOCKET'] = self.socket_path
+        else:
+            env['WEBSHOOTER_PORT'] = str(self.port)
         if self.proxy:
             env['WEBSHOOTER_PROXY'] = self.proxy
         if not self.headless:
@@ -116,89 +357,398 @@ class CaptureService():
         except Exception as e:
             logger.error('Failed to call node: '+str(e))
             raise e
-
-        logger.info('Warming up the headless browser...')
+    def wait_ready(self):
+        logger.info('Warming up the headless browser at %s...', self.endpoint)
         attempts_left = 10
         while attempts_left > 0:
             try:
                 self.client.status()
                 return True
+            except (ConnectionRefusedError, FileNotFoundError):
+                # service is not listening yet
+                attempts_left -= 1
             except Exception as e:
                 attempts_left -= 1
-                if 'connection refused' not in str(e).lower():
-                    logger.error('Failed to check status of capture service: '+str(e))
+                logger.error('Failed to check status of capture service: '+str(e))
             time.sleep(1)
-        self.shutdown()
+        self._stop_proc(graceful=False)
         raise CaptureError('Failed to start capture service')
+    def start_watchdog(self):
+        ''' restart the service if it dies or hangs and recycle the browser if it grows too big '''
+        self.watchdog_stop.clear()
+        self.watchdog = threading.Thread(target=self._watch, name='capture-watchdog', daemon=True)
+        self.watchdog.start()
+    def stop_watchdog(self):
+        self.watchdog_stop.set()
+        if self.watchdog and self.watchdog is not threading.current_thread():
+            self.watchdog.join()
+        self.watchdog = None
+    def _watch(self):
+        failures = 0
+        # generation and time of the last browser recycled for memory
+        recycled_generation = None
+        recycled_at = None
+        while not self.watchdog_stop.wait(self.WATCHDOG_INTERVAL_S):
+            proc = self.proc
+            if proc is None or proc.poll() is not None:
+                logger.error('Capture service at %s exited (%s). Restarting',
+                             self.endpoint, 'not running' if proc is None else proc.returncode)
+                self.restart()
+                failures = 0
+                # a new service numbers its browsers from the start again
+                recycled_generation = None
+                continue
+            try:
+                status = self.client.status()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.warning('Capture service at %s failed status check %d/%d: %s',
+                               self.endpoint, failures, self.WATCHDOG_MAX_FAILURES, str(e))
+                if failures >= self.WATCHDOG_MAX_FAILURES:
+                    logger.error('Capture service at %s is not responding. Restarting', self.endpoint)
+                    self.restart()
+                    failures = 0
+                    recycled_generation = None
+                continue
+            if self.browser_max_rss:
+                # the process tree includes retired browsers until they close. measuring then would
+                # blame the new browser for the old one's memory
+                if status.get('retiredBrowsers'):
+                    continue
+                generation = status.get('browserGeneration')
+                if generation == recycled_generation:
+                    # the replacement is launched with the next capture. until then this is still the old one
+                    continue
+                if recycled_at is not None and time.monotonic() - recycled_at < self.RECYCLE_COOLDOWN_S:
+                    continue
+                rss = tree_rss([proc.pid])
+                if rss is not None and rss > self.browser_max_rss:
+                    logger.info('Capture service at %s is using %d MB. Recycling the browser', self.endpoint, rss // 2**20)
+                    self.client.recycle()
+                    recycled_generation = generation
+                    recycled_at = time.monotonic()
+    def restart(self) -> bool:
+        if self.watchdog_stop.is_set() and self.watchdog is not None:
+            # shutting down
+            return False
+        self.client.available = False
+        self._stop_proc(graceful=False)
+        try:
+            self.launch()
+            self.wait_ready()
+        except Exception as e:
+            logger.error('Failed to restart capture service at %s: %s', self.endpoint, str(e))
+            return False
+        self.restarts += 1
+        self.client.available = True
+        return True
     def shutdown(self):
+        self.stop_watchdog()
+        self._stop_proc()
+    def _stop_proc(self, graceful: bool=True):
         if not self.proc:
             return
-        self.client.shutdown()
+        if graceful:
+            self.client.shutdown()
+        # drop kept-alive connections so they don't hold the node server open
+        self.client.close()
         try:
-            self.proc.wait(timeout=3)
+            self.proc.wait(timeout=3 if graceful else 0.1)
         except subprocess.TimeoutExpired:
             logger.debug('Forcibly terminating the capture service')
             self.proc.terminate()
+            try:
+                self.proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
         self.proc = None
+        if self.socket_path and os.path.exists(self.socket_path):
+            try:
+                os.remove(self.socket_path)
+            except OSError as err:
+                logger.error('Failed to remove socket %s: %s', self.socket_path, str(err))
+
+class CaptureServicePool():
+    '''
+    Runs `count` capture services, each with its own node process and browser, behind a single
+    client that sends each capture to the least busy service.
+    '''
+    def __init__(self, count: int, node_path: str, proxy: str=None, headless: bool=True, unix_socket: bool=False,
+                 **service_args):
+        if count < 1:
+            raise ValueError('need at least one capture service')
+        self.services = []
+        ports = set()
+        for _ in range(count):
+            port = None
+            if not unix_socket:
+                # find_free_port() releases the port immediately so avoid handing out the same one twice
+                port = find_free_port()
+                while port in ports:
+                    port = find_free_port()
+                ports.add(port)
+            self.services.append(CaptureService(node_path, proxy, headless, port, unix_socket, **service_args))
+        self.client = CaptureClientPool([s.client for s in self.services])
+    def __enter__(self) -> 'CaptureClientPool':
+        try:
+            # launch everything first so the browsers warm up in parallel
+            for s in self.services:
+                s.create_temp_dir()
+                s.launch()
+            for s in self.services:
+                s.wait_ready()
+            for s in self.services:
+                s.start_watchdog()
+        except:
+            self.__exit__(None, None, None)
+            raise
+        return self.client
+    def __exit__(self, type, value, traceback):
+        for s in self.services:
+            s.shutdown()
+        for s in self.services:
+            s.cleanup_temp_dir()
+    def rss(self) -> Optional[int]:
+        ''' resident memory of every capture service and its browser, if it can be measured '''
+        pids = [s.proc.pid for s in self.services if s.proc]
+        if len(pids) == 0:
+            return None
+        return tree_rss(pids)
+
+class Transport:
+    # service writes the image to disk and returns its path
+    FILE='file'
+    # service returns the image as base64 in the JSON response
+    INLINE='inline'
 
 class CaptureClient():
     DEFAULT_RENDER_WAIT_MS = 3000
     DEFAULT_PAGE_LOAD_TIMEOUT_MS = 10000
     GRACE_PERIOD_TIMEOUT_MS = 5000
+    # the longest settle wait the service gives each extra desktop or mobile view (VIEW_SETTLE_MS there)
+    VIEW_SETTLE_MS = 500
+    # screenshot and encode time for each extra image, and for a full page shot up to 16384 pixels tall
+    VIEW_SCREENSHOT_MS = 2000
+    FULL_PAGE_SCREENSHOT_MS = 10000
     def __init__(self, token: str, endpoint: str):
         self.endpoint = endpoint
         self.token = token
+        self.connections = ConnectionPool(endpoint)
+        # cleared while the service is being restarted
+        self.available = True
         # defaults
         self.render_wait_ms = self.DEFAULT_RENDER_WAIT_MS
         self.mobile = False
         # how long headless browser should wait for page load
         self.page_load_timeout_ms = self.DEFAULT_PAGE_LOAD_TIMEOUT_MS
-    def configure(self, mobile: bool, render_wait_ms: int, page_load_timeout_ms: int):
+        self.transport = Transport.FILE
+        self.adaptive_wait = False
+        self.block = None
+        self.image_format = ImageFormat.PNG
+        self.image_quality = None
+        self.thumbnail_width = 0
+        self.views = []
+    def configure(self, mobile: bool, render_wait_ms: int, page_load_timeout_ms: int, transport: str=Transport.FILE,
+                  adaptive_wait: bool=False, block: Optional[BlockProfile]=None, image_format: str=ImageFormat.PNG,
+                  image_quality: int=None, thumbnail_width: int=0, views: list[str]=None):
         self.mobile = mobile
         self.render_wait_ms = render_wait_ms
         self.page_load_timeout_ms = page_load_timeout_ms
+        self.transport = transport
+        self.adaptive_wait = adaptive_wait
+        self.block = block
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.thumbnail_width = thumbnail_width
+        # the main screenshot already covers one of desktop and mobile
+        main = View.MOBILE if mobile else View.DESKTOP
+        self.views = [v for v in (views or []) if v != main]
     def _service_timeout(self) -> int:
         ''' how long to wait for capture service to respond. should always be greater than
-            combined page load and render wait times
+            combined page load, render wait and extra view times
         '''
-        return math.ceil( (self.page_load_timeout_ms + self.render_wait_ms + self.GRACE_PERIOD_TIMEOUT_MS) / 1000 )
+        extra_ms = 0
+        for view in self.views:
+            if view == View.FULL:
+                extra_ms += self.FULL_PAGE_SCREENSHOT_MS
+            else:
+                extra_ms += min(self.render_wait_ms, self.VIEW_SETTLE_MS) + self.VIEW_SCREENSHOT_MS
+        if self.thumbnail_width:
+            extra_ms += self.VIEW_SCREENSHOT_MS
+        return math.ceil( (self.page_load_timeout_ms + self.render_wait_ms + extra_ms + self.GRACE_PERIOD_TIMEOUT_MS) / 1000 )
     def _headers(self) -> str:
         return {'token': self.token, 'content-type': 'application/json'}
-    def capture(self, url: str, headers: dict[str, str]) -> CaptureResponse:
+    def _write_inline_image(self, page_info: CaptureResponse, image_path: str, thumbnail_path: str=None,
+                            view_paths: dict[str, str]=None):
+        image = base64.b64decode(page_info['image'])
+        with open(image_path, 'wb') as fp:
+            fp.write(image)
+        page_info['image'] = ''
+        page_info['image_path'] = image_path
+        page_info['image_size'] = len(image)
+        page_info['image_sha256'] = hashlib.sha256(image).hexdigest()
+        if thumbnail_path and page_info.get('thumbnail'):
+            thumbnail = base64.b64decode(page_info['thumbnail'])
+            with open(thumbnail_path, 'wb') as fp:
+                fp.write(thumbnail)
+            page_info['thumbnail'] = ''
+            page_info['thumbnail_path'] = thumbnail_path
+            page_info['thumbnail_size'] = len(thumbnail)
+        view_paths = view_paths or {}
+        for view in page_info.get('views', []):
+            if view['image'] and view_paths.get(view['name']):
+                with open(view_paths[view['name']], 'wb') as fp:
+                    fp.write(base64.b64decode(view['image']))
+                view['image'] = ''
+                view['image_path'] = view_paths[view['name']]
+    def capture(self, url: str, headers: dict[str, str], image_path: str, thumbnail_path: str=None,
+                view_paths: dict[str, str]=None) -> CaptureResponse:
+        '''
+        take a screenshot of `url` and save it to `image_path`, with a thumbnail at `thumbnail_path`
+        and each configured view at `view_paths[name]`
+        '''
+        image_path = os.path.abspath(image_path)
+        if thumbnail_path:
+            thumbnail_path = os.path.abspath(thumbnail_path)
+        view_paths = {k: os.path.abspath(v) for k, v in (view_paths or {}).items() if k in self.views}
         body: CaptureRequest = {
             'url': url,
             'mobile': self.mobile,
             'render_wait_ms': self.render_wait_ms,
             'headers': headers,
-            'timeout_ms': self.page_load_timeout_ms
+            'timeout_ms': self.page_load_timeout_ms,
+            'adaptive_wait': self.adaptive_wait,
+            'block': self.block,
+            'image_format': self.image_format,
+            'image_quality': self.image_quality,
+            'thumbnail_width': self.thumbnail_width if thumbnail_path else 0,
+            'views': list(view_paths)
         }
-        req = urllib.request.Request(self.endpoint + '/capture', data=json.dumps(body).encode(), headers=self._headers(), method='POST')
+        if self.transport == Transport.FILE:
+            body['image_path'] = image_path
+            body['view_paths'] = view_paths
+            if thumbnail_path:
+                body['thumbnail_path'] = thumbnail_path
         err = None
+        start = time.monotonic()
         try:
-            with urllib.request.urlopen(req, timeout=self._service_timeout()) as resp:
-                if 200 <= resp.status < 300:
-                    page_info: CaptureResponse = json.load(resp)
-                    if len(page_info['image']) == 0:
-                        err = 'got zero-length image'
-                    else:
-                        return page_info
+            status, data = self._request('/capture', json.dumps(body).encode())
+            received = time.monotonic()
+            if 200 <= status < 300:
+                page_info: CaptureResponse = json.loads(data)
+                if self.transport == Transport.INLINE and len(page_info['image']) > 0:
+                    try:
+                        self._write_inline_image(page_info, image_path, thumbnail_path, view_paths)
+                    except OSError as e:
+                        # local disk trouble, e.g. a missing image directory. not the service going away
+                        raise CaptureError('failed to write image: ' + str(e))
+                timings = page_info.setdefault('timings', {})
+                self._add_timings(timings, start, received)
+                if page_info.get('image_size', 0) == 0:
+                    err = CaptureError('got zero-length image')
+                    err.timings = timings
                 else:
-                    err = json.load(resp)['error']
-        except urllib.error.HTTPError as e:
-            err = json.load(e)['error']
+                    return page_info
+            else:
+                err = self._error(data)
+                if isinstance(err, dict) and err.get('browser_lost'):
+                    err = CaptureUnavailable(err)
+                elif isinstance(err, dict) and err.get('name') == 'TimeoutError':
+                    err = CaptureTimeout(err)
+                else:
+                    err = CaptureError(err)
+                self._add_timings(err.timings, start, received)
+        except CaptureError as e:
+            err = e
+        except socket.timeout as e:
+            err = CaptureTimeout('capture service did not respond in time: ' + str(e))
+        except (ConnectionError, FileNotFoundError, http.client.HTTPException) as e:
+            # FileNotFoundError is a missing Unix socket
+            err = CaptureUnavailable('capture service unavailable: ' + str(e))
         except Exception as e:
-            err = str(e)
-        raise CaptureError(err)
+            err = CaptureError(str(e))
+        err.timings.setdefault(Stage.TOTAL, round((time.monotonic() - start) * 1000))
+        raise err
+    def _add_timings(self, timings: dict[str, int], start: float, received: float):
+        ''' add the time spent outside the capture service to the stage timings it reported '''
+        now = time.monotonic()
+        service_ms = timings.get(Stage.TOTAL, 0)
+        timings[Stage.TRANSPORT] = max(0, round((received - start) * 1000) - service_ms)
+        timings[Stage.DECODE] = round((now - received) * 1000)
+        timings[Stage.TOTAL] = round((now - start) * 1000)
+    def _request(self, path: str, body: bytes=None) -> tuple[int, bytes]:
+        return self.connections.request('POST', path, body, self._headers(), self._service_timeout())
+    def _error(self, data: bytes) -> Any:
+        try:
+            return json.loads(data)['error']
+        except (ValueError, KeyError, TypeError):
+            return data.decode(errors='replace')
     def shutdown(self):
         try:
-            req = urllib.request.Request(self.endpoint + '/shutdown', headers=self._headers(), method='POST')
-            urllib.request.urlopen(req, timeout=self._service_timeout())
+            self._request('/shutdown')
         except:
             logger.error('Failed to gracefully terminate capture service')
     def status(self) -> dict[str, Any]:
-        req = urllib.request.Request(self.endpoint + '/status', headers=self._headers(), method='POST')
+        status, data = self._request('/status')
+        if 200 <= status < 300:
+            return json.loads(data)
+        raise CaptureError(self._error(data))
+    def recycle(self):
+        ''' ask the service to replace its browser once in-flight captures finish '''
         try:
-            return json.load(urllib.request.urlopen(req, timeout=self._service_timeout()))
-        except urllib.error.HTTPError as e:
-            err = json.load(e)['error']
-        raise CaptureError(err)
+            self._request('/recycle')
+        except Exception as e:
+            logger.error('Failed to recycle browser: %s', str(e))
+    def close(self):
+        self.connections.close()
+
+class CaptureClientPool():
+    ''' Same interface as CaptureClient but spreads captures over several capture services '''
+    def __init__(self, clients: list[CaptureClient]):
+        self.clients = clients
+        self.in_flight = [0] * len(clients)
+        self.lock = threading.Lock()
+        self.next = 0
+        self.image_format = ImageFormat.PNG
+        self.thumbnail_width = 0
+        self.views = []
+    def configure(self, mobile: bool, render_wait_ms: int, page_load_timeout_ms: int, transport: str=Transport.FILE,
+                  adaptive_wait: bool=False, block: Optional[BlockProfile]=None, image_format: str=ImageFormat.PNG,
+                  image_quality: int=None, thumbnail_width: int=0, views: list[str]=None):
+        self.image_format = image_format
+        self.thumbnail_width = thumbnail_width
+        for c in self.clients:
+            c.configure(mobile, render_wait_ms, page_load_timeout_ms, transport, adaptive_wait, block,
+                        image_format, image_quality, thumbnail_width, views)
+        self.views = self.clients[0].views
+    def _acquire(self) -> int:
+        ''' pick the client with the fewest captures in flight. ties go round-robin '''
+        with self.lock:
+            n = len(self.clients)
+            order = [(self.next + k) % n for k in range(n)]
+            # skip services that are restarting unless there is nothing else
+            available = [j for j in order if self.clients[j].available] or order
+            i = min(available, key=lambda j: self.in_flight[j])
+            self.in_flight[i] += 1
+            self.next = (i + 1) % n
+            return i
+    def _release(self, i: int):
+        with self.lock:
+            self.in_flight[i] -= 1
+    def capture(self, url: str, headers: dict[str, str], image_path: str, thumbnail_path: str=None,
+                view_paths: dict[str, str]=None) -> CaptureResponse:
+        i = self._acquire()
+        try:
+            return self.clients[i].capture(url, headers, image_path, thumbnail_path, view_paths)
+        finally:
+            self._release(i)
+    def shutdown(self):
+        for c in self.clients:
+            c.shutdown()
+    def status(self) -> dict[str, Any]:
+        return self.clients[0].status()
+    def close(self):
+        for c in self.clients:
+            c.close()
@@ -4,14 +4,25 @@ const devices = puppeteer.KnownDevices;
 const express = require('express');
 const app = express();
 const crypto = require('crypto');
+const fs = require('fs');
+const path = require('path');
 
 const viewPortDims = {width: 1600, height: 900};
 
-if (typeof process.env.WEBSHOOTER_PORT === 'undefined') {
-    throw new Error('environment variable WEBSHOOTER_PORT is required');
+// listen on a Unix domain socket if given, otherwise a TCP port on localhost
+const socketPath = process.env.WEBSHOOTER_SOCKET;
+if (typeof socketPath === 'undefined' && typeof process.env.WEBSHOOTER_PORT === 'undefined') {
+    throw new Error('environment variable WEBSHOOTER_PORT or WEBSHOOTER_SOCKET is required');
 }
 const port = Number(process.env.WEBSHOOTER_PORT);
 
+// number of warm browser contexts to keep around between captures and how many captures each
+// context serves before it is thrown away. a pool size of 0 creates a fresh context per capture.
+const poolSize = Number(process.env.WEBSHOOTER_POOL_SIZE || 0);
+const poolMaxUses = Number(process.env.WEBSHOOTER_POOL_MAX_USES || 1);
+// replace the browser after this many captures. 0 keeps it until it crashes.
+const browserMaxCaptures = Number(process.env.WEBSHOOTER_BROWSER_MAX_CAPTURES || 0);
+
 if (typeof process.env.WEBSHOOTER_TOKEN === 'undefined') {
     throw new Error('environment variable WEBSHOOTER_TOKEN is required');
 }
@@ -54,31 +65,63 @@ Capture Request
     timeout_ms: <int>,
     mobile: <bool>,
     render_wait_ms: <int>,
-    headers: <array>
+    headers: <array>,
+    image_path: <string>   (optional. write the PNG here instead of returning base64)
+    adaptive_wait: <bool>  (optional. treat render_wait_ms as an upper bound and take the
+                            screenshot once the page stops changing)
+    block: {               (optional. requests to abort. the page itself is never blocked)
+        types: <array>,         resource types, e.g. "media", "font", "websocket"
+        patterns: <array>,      URL globs where * matches anything
+        third_party: <bool>     anything not on the same site as the page
+    },
+    image_format: <string> (optional. png, jpeg or webp. default png)
+    image_quality: <int>   (optional. 0-100 for jpeg and webp)
+    thumbnail_width: <int> (optional. also render a thumbnail this wide. jpeg unless the
+                            format is webp)
+    thumbnail_path: <string> (optional. like image_path, for the thumbnail)
+    views: <array>         (optional. extra screenshots taken after the first without loading the
+                            page again. "desktop", "mobile" or "full" for the whole page)
+    view_paths: <object>   (optional. view name -> path, like image_path)
 }
+
+Responses and errors carry `timings`: milliseconds spent in each stage of the capture, as far
+as it got, and `total` for the whole request.
 */
 app.post('/capture', async (req, res) => {
-    const context = await getBrowserContext();
-    //const context = await getBrowser().then(b => b.defaultBrowserContext());
-    const page = await context.newPage();
     const startTime = Date.now();
+    const timings = {};
+    let lease = undefined;
+    let entry = undefined;
     try {
-        const page_info = await capture(page, req.body);
+        let t = startTime;
+        lease = await browsers.acquire();
+        t = lap(timings, 'browser', t);
+        entry = await contextPool.acquire(lease);
+        lap(timings, 'context', t);
+        const page_info = await capture(entry.page, req.body, timings);
+        timings.total = Date.now() - startTime;
+        page_info.timings = timings;
         res.json(page_info);
     } catch (err) {
+        timings.total = Date.now() - startTime;
         res.status(500).json({
             error: {
                 name: err.name,
                 message: err.message,
-                elapsed: Date.now() - startTime
+                elapsed: timings.total,
+                timings: timings,
+                // the browser went away mid-capture. the URL itself may be fine
+                browser_lost: typeof lease === 'undefined' || typeof lease.browser === 'undefined' || !lease.browser.connected
             }
         });
     }
-    // wait for page to close to ensure we limit open windows. this should only matter for
-    // the default browser context since in that case, we can't close the context like we
-    // do for incognito mode.
-    await page.close();
-    context.close().catch(() => {/* browser was probably closed */});
+    if (typeof entry !== 'undefined') {
+        // wait for the page to be reset or closed to ensure we limit open windows
+        await contextPool.release(entry);
+    }
+    if (typeof lease !== 'undefined') {
+        browsers.release(lease);
+    }
 });
 
 app.post('/shutdown', async (req, res) => {
@@ -86,19 +129,44 @@ app.post('/shutdown', async (req, res) => {
     server.close(() => {
         console.log('Capture service going down');
     });
-    getBrowser().then((b) => {
-        b.close();
+    browsers.closeAll().then(() => {
         console.log('Closed browser instance');
     });
 });
 
+app.post('/recycle', async (req, res) => {
+    // new captures get a fresh browser. the old one closes once its captures finish
+    browsers.recycle();
+    res.json({generation: browsers.generation});
+});
+
+// how long the browser gets to answer a status check before it counts as hung
+const STATUS_TIMEOUT_MS = 5000;
+
+async function checkBrowser() {
+    let timer = undefined;
+    const timeout = new Promise((_, reject) => {
+        timer = setTimeout(() => reject(new Error('Browser did not answer within ' + STATUS_TIMEOUT_MS + 'ms')),
+                           STATUS_TIMEOUT_MS);
+    });
+    try {
+        // a round trip to the browser, so a wedged browser fails the check and not just a dead node
+        await Promise.race([getBrowser().then(browser => browser.version()), timeout]);
+    } finally {
+        clearTimeout(timer);
+    }
+}
+
 app.post('/status', async (req, res) => {
-    getUserAgent().then(userAgent => {
+    checkBrowser().then(getUserAgent).then(userAgent => {
         res.json({
             userAgent: userAgent,
             userAgentMobile: devices['iPhone X']['userAgent'],
             viewPort: viewPortDims,
-            viewPortMobile: devices['iPhone X']['viewport']
+            viewPortMobile: devices['iPhone X']['viewport'],
+            browserGeneration: browsers.generation,
+            browserCaptures: typeof browsers.lease === 'undefined' ? 0 : browsers.lease.captures,
+            retiredBrowsers: browsers.retiredCount()
         });
     }).catch(err => {
         res.status(500).json({
@@ -110,11 +178,25 @@ app.post('/status', async (req, res) => {
     })
 });
 
-var server = app.listen(port, '127.0.0.1', () => {
-    console.log('Started capture service on', port);
-});
+var server = undefined;
+if (typeof socketPath !== 'undefined') {
+    // a stale socket file from a crashed run would make listen() fail
+    fs.rmSync(socketPath, {force: true});
+    server = app.listen(socketPath, () => {
+        fs.chmodSync(socketPath, 0o600);
+        console.log('Started capture service on', socketPath);
+    });
+} else {
+    server = app.listen(port, '127.0.0.1', () => {
+        console.log('Started capture service on', port);
+    });
+}
+// the python client keeps connections open between captures. keep them around longer than the
+// node default of 5 seconds so slow captures on other workers don't cause reconnects
+server.keepAliveTimeout = 120 * 1000;
+server.headersTimeout = server.keepAliveTimeout + 1000;
 
-async function getBrowserContext() {
+async function getBrowserContext(browser) {
     // Must call close() on returned context when finished
     const config = {
         downloadBehavior: {
@@ -124,13 +206,116 @@ async function getBrowserContext() {
     if (typeof process.env.WEBSHOOTER_PROXY !== 'undefined') {
         config.proxyServer = process.env.WEBSHOOTER_PROXY;
     }
-    const browser = await getBrowser();
     const context = await browser.createBrowserContext(config);
     return context;
 }
 
-const getBrowser = function() {
-    let browser = undefined;
+async function dismissDialog(dialog) {
+    // dismiss dialogs. these can hang the screenshot
+    await dialog.dismiss().catch(() => {});
+}
+
+/*
+Warm, isolated browser contexts with one page each. Contexts are reset between captures and
+closed once they have served `maxUses` captures, when more than `size` of them are idle, or when
+the browser they belong to is retired.
+*/
+class ContextPool {
+    constructor(size, maxUses) {
+        this.size = size;
+        this.maxUses = Math.max(1, maxUses);
+        this.idle = [];
+    }
+
+    async create(lease) {
+        const context = await getBrowserContext(lease.browser);
+        try {
+            const page = await context.newPage();
+            const entry = {lease: lease, context: context, page: page, cdp: undefined, uses: 0, origins: new Set()};
+            if (this.size > 0) {
+                entry.cdp = await page.createCDPSession();
+            }
+            this.listen(entry);
+            return entry;
+        } catch (err) {
+            context.close().catch(() => {});
+            throw err;
+        }
+    }
+
+    listen(entry) {
+        entry.page.on('dialog', dismissDialog);
+        // remember every origin that answered so its storage can be cleared on release
+        entry.page.on('response', response => {
+            try {
+                const origin = new URL(response.url()).origin;
+                if (origin !== 'null') {
+                    entry.origins.add(origin);
+                }
+            } catch (err) { /* not a URL with an origin */ }
+        });
+    }
+
+    async acquire(lease) {
+        while (this.idle.length > 0) {
+            const entry = this.idle.pop();
+            if (entry.lease === lease) {
+                return entry;
+            }
+            await this.close(entry);
+        }
+        return await this.create(lease);
+    }
+
+    drop(lease) {
+        // close idle contexts that belong to a retired browser
+        const stale = this.idle.filter(entry => entry.lease === lease);
+        this.idle = this.idle.filter(entry => entry.lease !== lease);
+        for (const entry of stale) {
+            this.close(entry);
+        }
+    }
+
+    async reset(entry) {
+        const page = entry.page;
+        // stop anything still loading and drop handlers added by the last capture
+        await page.goto('about:blank', {timeout: 5000});
+        page.removeAllListeners();
+        await page.setRequestInterception(false);
+        await page.setExtraHTTPHeaders({});
+        await entry.cdp.send('Network.clearBrowserCookies');
+        for (const origin of entry.origins) {
+            await entry.cdp.send('Storage.clearDataForOrigin', {origin: origin, storageTypes: 'all'});
+        }
+        entry.origins.clear();
+        this.listen(entry);
+    }
+
+    async close(entry) {
+        await entry.page.close().catch(() => {});
+        await entry.context.close().catch(() => {/* browser was probably closed */});
+    }
+
+    async release(entry) {
+        entry.uses++;
+        if (entry.uses >= this.maxUses || this.idle.length >= this.size || entry.lease.retired) {
+            await this.close(entry);
+            return;
+        }
+        try {
+            await this.reset(entry);
+        } catch (err) {
+            console.log('Failed to reset browser context:', err.message);
+            await this.close(entry);
+            return;
+        }
+        this.idle.push(entry);
+    }
+}
+
+const contextPool = new ContextPool(poolSize, poolMaxUses);
+
+function browserLaunchArgs(generation) {
     const launchArgs = {
         args: [
             '--no-sandbox'
@@ -153,22 +338,146 @@ const getBrowser = function() {
         launchArgs.args.push(`--proxy-server=${process.env.WEBSHOOTER_PROXY}`);
     }
     if (typeof process.env.WEBSHOOTER_TEMP !== 'undefined') {
-        // this prevents loading the user's chromium settings including plugins
-        //cliArgs.push(`--user-data-dir=${process.env.WEBSHOOTER_TEMP}`);
-        launchArgs.userDataDir = process.env.WEBSHOOTER_TEMP;
+        // this prevents loading the user's chromium settings including plugins. each browser gets
+        // its own directory since a retired browser may still be running when the next one starts
+        launchArgs.userDataDir = path.join(process.env.WEBSHOOTER_TEMP, `browser-${generation}`);
     }
     if (typeof process.env.WEBSHOOTER_HEADLESS !== 'undefined') {
         launchArgs.headless = process.env.WEBSHOOTER_HEADLESS === 'yes';
     }
     // allow unsafe ports. this may not work with --headless option
     launchArgs.args.push('--explicitly-allowed-ports='+restrictedPorts.join(','));
-    return (async function() {
-        if (typeof browser === 'undefined') {
-            browser = await puppeteer.launch(launchArgs);
+    return launchArgs;
+}
+
+/*
+Owns the browser. Captures lease the current browser. A browser that crashes is replaced on the
+next capture, and after `maxCaptures` captures (0 means never) or a call to recycle() the browser
+is retired: new captures go to a fresh browser and the old one closes once its captures finish.
+*/
+class BrowserManager {
+    constructor(maxCaptures) {
+        this.maxCaptures = maxCaptures;
+        this.generation = 0;
+        // promise for the current lease while launching or running
+        this.current = undefined;
+        this.lease = undefined;
+        this.leases = new Set();
+        // retired browsers still shutting down
+        this.closing = 0;
+    }
+
+    launch() {
+        const generation = ++this.generation;
+        const launchArgs = browserLaunchArgs(generation);
+        const lease = {
+            browser: undefined, generation: generation, inFlight: 0, captures: 0,
+            retired: false, closed: false, dataDir: launchArgs.userDataDir
+        };
+        this.current = puppeteer.launch(launchArgs).then(browser => {
+            lease.browser = browser;
+            this.lease = lease;
+            this.leases.add(lease);
+            browser.on('disconnected', () => {
+                if (!lease.retired) {
+                    console.log('Browser disconnected. A new one will be launched for the next capture.');
+                }
+                lease.closed = true;
+                this.retire(lease);
+            });
+            return lease;
+        }).catch(err => {
+            this.current = undefined;
+            throw err;
+        });
+        return this.current;
+    }
+
+    async get() {
+        if (typeof this.current === 'undefined') {
+            this.launch();
         }
-        return browser;
-    });
-}();
+        return await this.current;
+    }
+
+    async acquire() {
+        const lease = await this.get();
+        lease.inFlight++;
+        lease.captures++;
+        if (this.maxCaptures > 0 && lease.captures >= this.maxCaptures) {
+            console.log('Recycling browser after', lease.captures, 'captures');
+            this.retire(lease);
+        }
+        return lease;
+    }
+
+    release(lease) {
+        lease.inFlight--;
+        this.closeIfIdle(lease);
+    }
+
+    retire(lease) {
+        if (lease.retired) {
+            return;
+        }
+        lease.retired = true;
+        if (this.lease === lease) {
+            this.lease = undefined;
+            this.current = undefined;
+        }
+        contextPool.drop(lease);
+        this.closeIfIdle(lease);
+    }
+
+    recycle() {
+        if (typeof this.lease !== 'undefined') {
+            console.log('Recycling browser on request');
+            this.retire(this.lease);
+        }
+    }
+
+    closeIfIdle(lease) {
+        if (!lease.retired || lease.inFlight > 0) {
+            return;
+        }
+        this.leases.delete(lease);
+        const browser = lease.browser;
+        const closing = lease.closed ? Promise.resolve() : browser.close().catch(() => {});
+        lease.closed = true;
+        this.closing++;
+        closing.then(() => {
+            this.closing--;
+            if (typeof lease.dataDir !== 'undefined') {
+                fs.rm(lease.dataDir, {recursive: true, force: true}, () => {});
+            }
+        });
+    }
+
+    retiredCount() {
+        // retired browsers still finishing captures or closing. they count towards memory use
+        let draining = 0;
+        for (const lease of this.leases) {
+            if (lease.retired) {
+                draining++;
+            }
+        }
+        return draining + this.closing;
+    }
+
+    async closeAll() {
+        const leases = Array.from(this.leases);
+        this.current = undefined;
+        this.lease = undefined;
+        this.leases.clear();
+        await Promise.all(leases.map(lease => lease.browser.close().catch(() => {})));
+    }
+}
+
+const browsers = new BrowserManager(browserMaxCaptures);
+
+async function getBrowser() {
+    return (await browsers.get()).browser;
+}
 
 const getUserAgent = function() {
     let userAgent = undefined;
@@ -185,36 +494,246 @@ function sleep(millisec) {
     return new Promise(resolve => setTimeout(resolve, millisec));
 }
 
-async function capture(page, opts) {
-    // dismiss dialogs. these can hang the screenshot
-    page.on('dialog', async dialog => {
-        await dialog.dismiss();
+// how long the network and layout must stay quiet before a page counts as rendered
+const RENDER_IDLE_MS = 300;
+const RENDER_POLL_MS = 100;
+
+async function renderSignature(page) {
+    // count DOM mutations from here on and summarize anything that changes what gets painted
+    return await page.evaluate(() => {
+        if (typeof window.__webshooterMutations === 'undefined') {
+            window.__webshooterMutations = 0;
+            new MutationObserver(records => {
+                window.__webshooterMutations += records.length;
+            }).observe(document, {subtree: true, childList: true, attributes: true, characterData: true});
+        }
+        const body = document.body;
+        let pendingImages = 0;
+        for (const img of document.images) {
+            if (!img.complete) {
+                pendingImages++;
+            }
+        }
+        return [
+            document.readyState,
+            document.fonts ? document.fonts.status : '',
+            body ? body.scrollWidth : 0,
+            body ? body.scrollHeight : 0,
+            pendingImages,
+            window.__webshooterMutations
+        ].join(',');
+    });
+}
+
+async function waitForRender(page, opts) {
+    // returns how long we actually waited
+    const startTime = Date.now();
+    if (!opts.adaptive_wait) {
+        await sleep(opts.render_wait_ms);
+        return Date.now() - startTime;
+    }
+    const deadline = startTime + opts.render_wait_ms;
+    await page.waitForNetworkIdle({
+        idleTime: RENDER_IDLE_MS,
+        timeout: Math.max(1, deadline - Date.now())
+    }).catch(() => { /* hit the cap. take the screenshot anyway */ });
+    let last = undefined;
+    let stableSince = Date.now();
+    while (Date.now() < deadline) {
+        const signature = await renderSignature(page).catch(() => undefined);
+        if (typeof signature === 'undefined' || signature !== last) {
+            last = signature;
+            stableSince = Date.now();
+        } else if (Date.now() - stableSince >= RENDER_IDLE_MS) {
+            break;
+        }
+        await sleep(Math.min(RENDER_POLL_MS, Math.max(0, deadline - Date.now())));
+    }
+    return Date.now() - startTime;
+}
+
+function globToRegExp(glob) {
+    const escaped = glob.replace(/[.+?^${}()|[\]\\]/g, '\\$&').replace(/\*/g, '.*');
+    return new RegExp('^' + escaped + '$', 'i');
+}
+
+function siteOf(hostname) {
+    // close enough to the registrable domain without a public suffix list. errs on the side of
+    // treating hosts as the same site, e.g. every .co.uk host
+    if (/^[0-9.]+$/.test(hostname) || hostname.includes(':')) {
+        return hostname;
+    }
+    return hostname.split('.').slice(-2).join('.');
+}
+
+function blockReason(request, page, block, patterns) {
+    if (request.isNavigationRequest() && request.frame() === page.mainFrame()) {
+        return undefined;
+    }
+    const type = request.resourceType();
+    if (Array.isArray(block.types) && block.types.includes(type)) {
+        return type;
+    }
+    const url = request.url();
+    if (patterns.some(re => re.test(url))) {
+        return 'pattern';
+    }
+    if (block.third_party) {
+        try {
+            const target = new URL(url);
+            const top = new URL(page.mainFrame().url());
+            if (target.protocol.startsWith('http') && top.protocol.startsWith('http') &&
+                siteOf(target.hostname) !== siteOf(top.hostname)) {
+                return 'third_party';
+            }
+        } catch (err) { /* data: and friends have no site */ }
+    }
+    return undefined;
+}
+
+async function interceptRequests(page, block, counters) {
+    // abort requests matching `block` and count what was loaded and what was not
+    page.on('requestfinished', request => {
+        const response = request.response();
+        const length = response ? Number(response.headers()['content-length']) : NaN;
+        if (!isNaN(length)) {
+            counters.bytes_received += length;
+        }
+    });
+    block = block || {};
+    const patterns = (block.patterns || []).map(globToRegExp);
+    const intercept = (block.types || []).length > 0 || patterns.length > 0 || !!block.third_party;
+    if (intercept) {
+        await page.setRequestInterception(true);
+    }
+    page.on('request', request => {
+        if (!intercept) {
+            counters.requests++;
+            return;
+        }
+        if (request.isInterceptResolutionHandled()) {
+            return;
+        }
+        const reason = blockReason(request, page, block, patterns);
+        if (typeof reason === 'undefined') {
+            counters.requests++;
+            request.continue().catch(() => {});
+            return;
+        }
+        counters.blocked++;
+        counters.blocked_by[reason] = (counters.blocked_by[reason] || 0) + 1;
+        request.abort('blockedbyclient').catch(() => {});
     });
+}
+
+const imageFormats = ['png', 'jpeg', 'webp'];
 
-    page.setExtraHTTPHeaders(opts.headers);
-    if (opts.mobile) {
+function screenshotOptions(format, quality) {
+    if (!imageFormats.includes(format)) {
+        format = 'png';
+    }
+    const options = {type: format};
+    if (format !== 'png' && Number.isInteger(quality)) {
+        options.quality = Math.min(100, Math.max(0, quality));
+    }
+    return options;
+}
+
+function lap(timings, stage, start) {
+    // add the time since `start` to `stage`. returns now, the start of the next stage
+    const now = Date.now();
+    timings[stage] = (timings[stage] || 0) + now - start;
+    return now;
+}
+
+async function saveImage(image, imagePath) {
+    // returns [base64, path]. skip the base64 round trip when the client gave us a path
+    if (typeof imagePath === 'string' && imagePath.length > 0) {
+        if (!path.isAbsolute(imagePath)) {
+            throw new Error('image paths must be absolute');
+        }
+        await fs.promises.writeFile(imagePath, image);
+        return ['', imagePath];
+    }
+    return [image.toString('base64'), ''];
+}
+
+async function setViewport(page, mobile) {
+    if (mobile) {
         // see https://github.com/puppeteer/puppeteer/blob/main/src/common/DeviceDescriptors.ts
-        page.emulate(devices['iPhone X']);
+        await page.emulate(devices['iPhone X']);
     } else {
         const userAgent = await getUserAgent();
+        // pooled pages may have been used for mobile emulation
+        await page.setViewport(viewPortDims);
         await page.setUserAgent(userAgent);
     }
+}
+
+// how long to let the layout settle after the viewport changes, and the tallest full-page shot
+const VIEW_SETTLE_MS = 500;
+const FULL_PAGE_MAX_HEIGHT = 16384;
+
+async function captureViews(page, opts, format) {
+    // full page first, while the page still has the viewport of the main screenshot
+    const names = Array.from(new Set(opts.views)).sort((a, b) => (b === 'full') - (a === 'full'));
+    const viewPaths = opts.view_paths || {};
+    const views = [];
+    for (const name of names) {
+        const options = screenshotOptions(format, opts.image_quality);
+        if (name === 'full') {
+            const viewport = page.viewport() || viewPortDims;
+            const height = await page.evaluate(() => document.documentElement.scrollHeight).catch(() => viewport.height);
+            options.clip = {x: 0, y: 0, width: viewport.width, height: Math.min(Math.max(height, viewport.height), FULL_PAGE_MAX_HEIGHT)};
+            options.captureBeyondViewport = true;
+        } else if (name === 'desktop' || name === 'mobile') {
+            // responsive layouts follow the viewport. the user agent of the loaded page does not change
+            await setViewport(page, name === 'mobile');
+            await waitForRender(page, {adaptive_wait: opts.adaptive_wait, render_wait_ms: Math.min(opts.render_wait_ms, VIEW_SETTLE_MS)});
+        } else {
+            throw new Error(`unknown view: ${name}`);
+        }
+        const image = Buffer.from(await page.screenshot(options));
+        const view = {
+            name: name,
+            image: '',
+            image_path: '',
+            image_size: image.length,
+            image_sha256: crypto.createHash('sha256').update(image).digest('hex')
+        };
+        [view.image, view.image_path] = await saveImage(image, viewPaths[name]);
+        views.push(view);
+    }
+    return views;
+}
 
+async function capture(page, opts, timings) {
+    let t = Date.now();
+    // bytes_received only counts responses that give a content-length. blocked requests never
+    // start, so their size is unknown
+    const counters = {requests: 0, blocked: 0, blocked_by: {}, bytes_received: 0};
+    await interceptRequests(page, opts.block, counters);
+    await page.setExtraHTTPHeaders(opts.headers);
+    await setViewport(page, opts.mobile);
+    t = lap(timings, 'context', t);
+
+    // wait for `domcontentloaded` and then give the `load` event whatever is left of the timeout.
+    // navigating a second time after a `load` timeout could take twice the timeout.
+    const navStart = Date.now();
     const response = await page.goto(opts.url, {
         // See https://puppeteer.github.io/puppeteer/docs/puppeteer.page.goto#remarks
-        waitUntil: ['load'],
+        waitUntil: ['domcontentloaded'],
         timeout: opts.timeout_ms
-    }).
-        catch(err => {
-            if (err.name === 'TimeoutError') {
-                console.log('Timeout waiting for `load` event. Trying again with `domcontentloaded`.');
-                return page.goto(opts.url, {
-                    waitUntil: ['domcontentloaded'],
-                    timeout: opts.timeout_ms
-                });
-            }
-            throw err;
-        });
+    });
+    t = lap(timings, 'navigate', t);
+    let loadFallback = false;
+    await page.waitForFunction(() => document.readyState === 'complete', {
+        timeout: Math.max(1, opts.timeout_ms - (Date.now() - navStart))
+    }).catch(err => {
+        console.log('Timeout waiting for `load` event. Using `domcontentloaded`.');
+        loadFallback = true;
+    });
+    t = lap(timings, 'load', t);
 
     const page_info = {
         url_final: page.url(),
@@ -222,12 +741,45 @@ async function capture(page, opts) {
         headers: response.headers(),
         status: response.status(),
         security: response.securityDetails(),
-        image: ''
+        image: '',
+        image_path: '',
+        image_size: 0,
+        image_sha256: '',
+        thumbnail: '',
+        thumbnail_path: '',
+        thumbnail_size: 0,
+        views: [],
+        render_wait_ms: 0,
+        timeout_ms: opts.timeout_ms,
+        load_fallback: loadFallback
     };
     // give page time to render
-    await sleep(opts.render_wait_ms);
-    page_info.image = await page.screenshot({
-        encoding: 'base64',
-    });
+    page_info.render_wait_ms = await waitForRender(page, opts);
+    page_info.requests = counters;
+    t = lap(timings, 'render', t);
+    const format = opts.image_format || 'png';
+    const image = Buffer.from(await page.screenshot(screenshotOptions(format, opts.image_quality)));
+    page_info.image_size = image.length;
+    page_info.image_sha256 = crypto.createHash('sha256').update(image).digest('hex');
+    t = lap(timings, 'screenshot', t);
+    [page_info.image, page_info.image_path] = await saveImage(image, opts.image_path);
+    t = lap(timings, 'save', t);
+    if (opts.thumbnail_width > 0) {
+        // render the viewport again at a smaller scale rather than resizing the full image
+        const viewport = page.viewport() || viewPortDims;
+        const thumbnailOptions = screenshotOptions(format === 'webp' ? 'webp' : 'jpeg', opts.image_quality);
+        thumbnailOptions.clip = {
+            x: 0, y: 0, width: viewport.width, height: viewport.height,
+            // output pixels are css pixels * scale * device pixel ratio
+            scale: Math.min(1, opts.thumbnail_width / (viewport.width * (viewport.deviceScaleFactor || 1)))
+        };
+        const thumbnail = Buffer.from(await page.screenshot(thumbnailOptions));
+        page_info.thumbnail_size = thumbnail.length;
+        t = lap(timings, 'screenshot', t);
+        [page_info.thumbnail, page_info.thumbnail_path] = await saveImage(thumbnail, opts.thumbnail_path);
+        t = lap(timings, 'save', t);
+    }
+    page_info.views = Array.isArray(opts.views) ? await captureViews(page, opts, format) : [];
+    lap(timings, 'views', t);
     return page_info;
 }
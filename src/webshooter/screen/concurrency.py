@@ -0,0 +1,85 @@
+import time
+import logging
+import statistics
+import threading
+from collections.abc import Callable
+from typing import Optional
+
+logger = logging.getLogger(__package__)
+
+class ConcurrencyController():
+    '''
+    Additive-increase/multiplicative-decrease limit on captures in flight. Every `interval_s` the
+    captures finished since the last check are examined. The limit is cut by `backoff` if too many
+    failed or timed out, if median latency rose well above the best seen so far, or if `rss()`
+    reports more than `max_rss` bytes. Otherwise, if the limit was actually reached, it grows by one.
+    '''
+    def __init__(self, floor: int, ceiling: int, start: int=None, interval_s: float=5.0, min_samples: int=5,
+                 max_error_rate: float=0.25, latency_factor: float=2.0, backoff: float=0.75,
+                 max_rss: int=None, rss: Callable[[], Optional[int]]=None):
+        if floor < 1 or ceiling < floor:
+            raise ValueError('need 1 <= floor <= ceiling')
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = min(max(start or floor, floor), ceiling)
+        self.interval_s = interval_s
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.latency_factor = latency_factor
+        self.backoff = backoff
+        self.max_rss = max_rss
+        self.rss = rss
+        self.baseline_latency = None
+        self.latencies = []
+        self.failures = 0
+        self.saturated = False
+        self.last_check = time.monotonic()
+        self.lock = threading.Lock()
+    def record(self, latency_s: float, failed: bool):
+        ''' a capture finished. `failed` covers errors and timeouts '''
+        with self.lock:
+            self.latencies.append(latency_s)
+            if failed:
+                self.failures += 1
+    def in_flight(self, count: int):
+        ''' tell the controller how many captures are running so it knows if the limit is in use '''
+        if count >= self.limit:
+            self.saturated = True
+    def _set(self, limit: int, reason: str):
+        limit = min(max(limit, self.floor), self.ceiling)
+        if limit != self.limit:
+            logger.info('Concurrency %d -> %d: %s', self.limit, limit, reason)
+            self.limit = limit
+    def adjust(self) -> int:
+        ''' call regularly. returns the current limit '''
+        now = time.monotonic()
+        if now - self.last_check < self.interval_s:
+            return self.limit
+        rss = self.rss() if (self.rss and self.max_rss) else None
+        with self.lock:
+            if len(self.latencies) < self.min_samples and rss is None:
+                return self.limit
+            latencies, failures = self.latencies, self.failures
+            self.latencies, self.failures = [], 0
+        saturated, self.saturated = self.saturated, False
+        self.last_check = now
+
+        if rss is not None and rss > self.max_rss:
+            self._set(int(self.limit * self.backoff), 'browser RSS {} MB over limit'.format(rss // 2**20))
+            return self.limit
+        if len(latencies) < self.min_samples:
+            return self.limit
+        error_rate = failures / len(latencies)
+        latency = statistics.median(latencies)
+        if self.baseline_latency is None:
+            self.baseline_latency = latency
+        if error_rate > self.max_error_rate:
+            self._set(int(self.limit * self.backoff), '{:.0%} of captures failed'.format(error_rate))
+        elif latency > self.baseline_latency * self.latency_factor:
+            self._set(int(self.limit * self.backoff),
+                      'median latency {:.1f}s vs {:.1f}s baseline'.format(latency, self.baseline_latency))
+        elif saturated:
+            self._set(self.limit + 1, 'median latency {:.1f}s, {:.0%} failed'.format(latency, error_rate))
+        # track the best latency seen but let it drift up slowly so one fast window doesn't pin it
+        self.baseline_latency = min(latency, self.baseline_latency * 1.05)
+        return self.limit
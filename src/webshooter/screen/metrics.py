@@ -0,0 +1,152 @@
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+from webshooter.screen.session import Status, Stage, CaptureTiming
+from webshooter.screen.procstat import process_rss
+from webshooter.screen.stats import STATUS_NAMES
+
+logger = logging.getLogger(__package__)
+
+# histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120]
+# captures per second is averaged over this many seconds
+RATE_WINDOW_S = 60
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+class Histogram():
+    ''' cumulative buckets in the Prometheus style '''
+    def __init__(self, buckets: list[float]=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    def lines(self, name: str, labels: str='') -> list[str]:
+        lines = []
+        total = 0
+        for bound, n in zip([*map(str, self.buckets), '+Inf'], self.counts):
+            total += n
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels + ',' if labels else '', bound, total))
+        lines.append('{}_sum{} {}'.format(name, '{' + labels + '}' if labels else '', self.sum))
+        lines.append('{}_count{} {}'.format(name, '{' + labels + '}' if labels else '', self.count))
+        return lines
+
+class ScanMetrics():
+    '''
+    Live counters for a running scan, served in the Prometheus text format by `serve`. The scan
+    loop reports progress, and the session passes every capture timing it writes to `timing`.
+    `rss` returns the resident memory of the capture services and their browsers.
+    '''
+    def __init__(self, rss: Callable[[], Optional[int]]=None):
+        self.rss = rss
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.queued = 0
+        self.in_flight = 0
+        self.concurrency_limit = None
+        self.write_queue = None
+        self.results = {name: 0 for name in STATUS_NAMES.values()}
+        self.finish_times = deque()
+        self.stages = {stage: Histogram() for stage in Stage.ALL if stage != Stage.COMMIT}
+        self.commit = Histogram()
+        self.server = None
+    def progress(self, queued: int, in_flight: int, concurrency_limit: int=None, write_queue: int=None):
+        with self.lock:
+            self.queued = queued
+            self.in_flight = in_flight
+            self.concurrency_limit = concurrency_limit
+            self.write_queue = write_queue
+    def finished(self):
+        ''' a URL is done. lost captures are counted by `timing` but go back in the queue '''
+        now = time.monotonic()
+        with self.lock:
+            self.finish_times.append(now)
+            while self.finish_times[0] < now - RATE_WINDOW_S:
+                self.finish_times.popleft()
+    def timing(self, timing: CaptureTiming):
+        with self.lock:
+            name = STATUS_NAMES.get(timing['result'], str(timing['result']))
+            self.results[name] = self.results.get(name, 0) + 1
+            for stage, ms in timing['timings'].items():
+                if stage == Stage.COMMIT:
+                    self.commit.observe(ms / 1000)
+                elif stage in self.stages and timing['result'] == Status.FINISHED:
+                    self.stages[stage].observe(ms / 1000)
+    def rate(self) -> float:
+        ''' URLs finished per second over the last RATE_WINDOW_S '''
+        now = time.monotonic()
+        with self.lock:
+            recent = [t for t in self.finish_times if t >= now - RATE_WINDOW_S]
+        return len(recent) / min(RATE_WINDOW_S, max(1.0, time.time() - self.started))
+    def render(self) -> str:
+        rss = self.rss() if self.rss else None
+        rate = self.rate()
+        lines = []
+        def metric(name: str, kind: str, help: str):
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+        with self.lock:
+            metric('webshooter_urls_queued', 'gauge', 'URLs of the current pass not yet captured')
+            lines.append('webshooter_urls_queued {}'.format(self.queued))
+            metric('webshooter_captures_in_flight', 'gauge', 'captures running or waiting for a worker')
+            lines.append('webshooter_captures_in_flight {}'.format(self.in_flight))
+            if self.concurrency_limit is not None:
+                metric('webshooter_concurrency_limit', 'gauge', 'captures allowed at once by the auto-tuner')
+                lines.append('webshooter_concurrency_limit {}'.format(self.concurrency_limit))
+            metric('webshooter_captures_total', 'counter', 'capture attempts by result. lost attempts are retried')
+            for name, n in sorted(self.results.items()):
+                lines.append('webshooter_captures_total{{result="{}"}} {}'.format(name, n))
+            metric('webshooter_captures_per_second', 'gauge', 'URLs finished per second over the last minute')
+            lines.append('webshooter_captures_per_second {:.3f}'.format(rate))
+            metric('webshooter_capture_stage_seconds', 'histogram', 'time spent in each stage of finished captures')
+            for stage, h in self.stages.items():
+                lines += h.lines('webshooter_capture_stage_seconds', 'stage="{}"'.format(stage))
+            metric('webshooter_session_commit_seconds', 'histogram', 'time from queueing a result until it was committed')
+            lines += self.commit.lines('webshooter_session_commit_seconds')
+            if self.write_queue is not None:
+                metric('webshooter_session_write_queue', 'gauge', 'session records waiting to be committed')
+                lines.append('webshooter_session_write_queue {}'.format(self.write_queue))
+        if rss is not None:
+            metric('webshooter_capture_service_rss_bytes', 'gauge', 'resident memory of node and its browsers')
+            lines.append('webshooter_capture_service_rss_bytes {}'.format(rss))
+        own = process_rss()
+        if own is not None:
+            metric('process_resident_memory_bytes', 'gauge', 'resident memory of this process')
+            lines.append('process_resident_memory_bytes {}'.format(own))
+        metric('process_start_time_seconds', 'gauge', 'when the scan started, in seconds since the epoch')
+        lines.append('process_start_time_seconds {:.3f}'.format(self.started))
+        return '\n'.join(lines) + '\n'
+    def serve(self, port: int, host: str='127.0.0.1'):
+        ''' serve /metrics from a background thread until `stop` '''
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                logger.debug('metrics: ' + format, *args)
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('Serving metrics on http://%s:%d/metrics', host, self.server.server_port)
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,57 @@
+import os
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__package__)
+
+PROC = '/proc'
+
+def _children() -> dict[int, list[int]]:
+    ''' map of parent pid to child pids for every process we can see '''
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir(PROC):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(PROC, entry, 'stat')) as fp:
+                stat = fp.read()
+        except OSError:
+            continue
+        # the command name is in parens and may contain spaces. ppid is the 2nd field after it
+        fields = stat[stat.rfind(')') + 2:].split()
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    return children
+
+def _rss(pid: int) -> int:
+    try:
+        with open(os.path.join(PROC, str(pid), 'statm')) as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return 0
+
+def process_rss(pid: int=None) -> Optional[int]:
+    ''' resident memory in bytes of one process, this one by default. None where /proc is not available '''
+    if not os.path.isdir(PROC):
+        return None
+    return _rss(pid or os.getpid())
+
+def tree_rss(pids: list[int]) -> Optional[int]:
+    '''
+    Resident memory in bytes of `pids` and all of their descendants, e.g. node and every Chromium
+    process it started. Shared pages are counted once per process so this overestimates. Returns
+    None where /proc is not available.
+    '''
+    if not os.path.isdir(PROC):
+        return None
+    children = _children()
+    total = 0
+    seen = set()
+    todo = list(pids)
+    while todo:
+        pid = todo.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        total += _rss(pid)
+        todo.extend(children.get(pid, []))
+    return total
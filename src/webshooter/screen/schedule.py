@@ -0,0 +1,160 @@
+import time
+import heapq
+import socket
+import logging
+import ipaddress
+import threading
+import urllib.parse
+from collections import deque
+from collections.abc import Iterable
+from typing import Optional
+
+logger = logging.getLogger(__package__)
+
+class HostScheduler():
+    '''
+    Hands out URLs round-robin across hosts so one host with many ports cannot take every worker.
+    A host is held back while it has `per_host` captures in flight or its last capture started
+    less than `spacing_s` seconds ago. With `per_ip`, hosts that resolve to the same address
+    share a cap as well. A cap of 0 means unlimited.
+
+    Only `lookahead` URLs are read from `urls` at a time so memory stays bounded. While every
+    buffered host is held back, up to OVERFLOW times that many are read looking for another host.
+    '''
+    OVERFLOW = 10
+    def __init__(self, urls: Iterable[str], per_host: int=0, per_ip: int=0, spacing_s: float=0.0, lookahead: int=1000):
+        self.urls = iter(urls)
+        self.per_host = per_host
+        self.per_ip = per_ip
+        self.spacing_s = spacing_s
+        self.lookahead = lookahead
+        self.exhausted = False
+        self.buffered = 0
+        # host -> URLs waiting for it, in the order hosts are visited
+        self.pending: dict[str, deque[str]] = {}
+        self.ring: deque[str] = deque()
+        self.host_in_flight: dict[str, int] = {}
+        self.ip_in_flight: dict[str, int] = {}
+        self.last_start: dict[str, float] = {}
+        # last_start is pruned of idle hosts once it grows past this
+        self.prune_at = lookahead
+        self.ips: dict[str, str] = {}
+        # (ready time, sequence, url) for URLs put back by requeue()
+        self.delayed: list[tuple[float, int, str]] = []
+        self.delayed_seq = 0
+        self.lock = threading.Lock()
+    @staticmethod
+    def host(url: str) -> str:
+        return (urllib.parse.urlparse(url).hostname or '').lower()
+    def _ip(self, host: str) -> str:
+        if host not in self.ips:
+            try:
+                ipaddress.ip_address(host)
+                self.ips[host] = host
+            except ValueError:
+                try:
+                    self.ips[host] = socket.getaddrinfo(host, None)[0][4][0]
+                except (OSError, UnicodeError):
+                    # let the capture fail on its own. treat it as its own address
+                    self.ips[host] = host
+        return self.ips[host]
+    def _add(self, url: str):
+        host = self.host(url)
+        if host not in self.pending:
+            self.pending[host] = deque()
+            self.ring.append(host)
+        self.pending[host].append(url)
+        self.buffered += 1
+    def _fill(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            self._add(heapq.heappop(self.delayed)[2])
+        while not self.exhausted and self.buffered < self.lookahead:
+            url = next(self.urls, None)
+            if url is None:
+                self.exhausted = True
+                return
+            self._add(url)
+    def _read_ready(self, now: float) -> Optional[str]:
+        ''' read past the lookahead until a URL for a host that may start now turns up '''
+        while not self.exhausted and self.buffered < self.lookahead * self.OVERFLOW:
+            url = next(self.urls, None)
+            if url is None:
+                self.exhausted = True
+                return None
+            self._add(url)
+            host = self.host(url)
+            if self._ready(host, now):
+                return host
+        return None
+    def _prune(self, now: float):
+        ''' forget start times of hosts that are idle and past their spacing '''
+        for host, start in list(self.last_start.items()):
+            if now - start >= self.spacing_s and host not in self.host_in_flight and host not in self.pending:
+                del self.last_start[host]
+        self.prune_at = max(self.lookahead, 2 * len(self.last_start))
+    def _ready(self, host: str, now: float) -> bool:
+        if self.per_host and self.host_in_flight.get(host, 0) >= self.per_host:
+            return False
+        if self.per_ip and self.ip_in_flight.get(self._ip(host), 0) >= self.per_ip:
+            return False
+        if self.spacing_s and now - self.last_start.get(host, -self.spacing_s) < self.spacing_s:
+            return False
+        return True
+    def next(self) -> Optional[str]:
+        ''' next URL that may be started now, or None if every waiting host is held back '''
+        with self.lock:
+            self._fill()
+            now = time.monotonic()
+            if len(self.last_start) > self.prune_at:
+                self._prune(now)
+            for _ in range(len(self.ring)):
+                host = self.ring[0]
+                # whatever happens, the next search starts with the following host
+                self.ring.rotate(-1)
+                if self._ready(host, now):
+                    return self._take(host, now)
+            # every buffered host is held back. a host further on in the input may not be
+            host = self._read_ready(now)
+            if host is not None:
+                return self._take(host, now)
+            return None
+    def _take(self, host: str, now: float) -> str:
+        ''' start the next URL of `host`, which must be last in the ring '''
+        urls = self.pending[host]
+        url = urls.popleft()
+        self.buffered -= 1
+        if len(urls) == 0:
+            del self.pending[host]
+            self.ring.pop()
+        self.host_in_flight[host] = self.host_in_flight.get(host, 0) + 1
+        if self.per_ip:
+            ip = self._ip(host)
+            self.ip_in_flight[ip] = self.ip_in_flight.get(ip, 0) + 1
+        self.last_start[host] = now
+        return url
+    def done(self, url: str):
+        ''' a URL returned by next() has finished '''
+        host = self.host(url)
+        with self.lock:
+            self.host_in_flight[host] -= 1
+            if self.host_in_flight[host] == 0:
+                del self.host_in_flight[host]
+                # keep the start time until the spacing has passed so the host's next URL still waits
+                if host not in self.pending and time.monotonic() - self.last_start.get(host, 0) >= self.spacing_s:
+                    self.last_start.pop(host, None)
+            if self.per_ip:
+                ip = self._ip(host)
+                self.ip_in_flight[ip] -= 1
+                if self.ip_in_flight[ip] == 0:
+                    del self.ip_in_flight[ip]
+    def requeue(self, url: str, delay_s: float=0.0):
+        ''' hand out a finished URL again after `delay_s` seconds '''
+        with self.lock:
+            heapq.heappush(self.delayed, (time.monotonic() + delay_s, self.delayed_seq, url))
+            self.delayed_seq += 1
+    def finished(self) -> bool:
+        ''' true once every URL has been handed out '''
+        with self.lock:
+            self._fill()
+            return self.exhausted and self.buffered == 0 and not self.delayed
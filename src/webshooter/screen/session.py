@@ -1,10 +1,15 @@
 import os
 import json
+import time
+import queue
+import atexit
 import sqlite3
 import logging
 import threading
+import itertools
 import urllib.parse
-from typing import Any
+from typing import Any, Optional, TypedDict
+from collections.abc import Callable, Iterable, Iterator
 
 logger = logging.getLogger(__package__)
 
@@ -14,80 +19,530 @@ class Status:
     ERROR=2
     INVALID=3
     DUPLICATE=4
+    # page load timed out. may succeed on a later pass with a longer timeout
+    TIMEOUT=5
+
+class Stage:
+    ''' timed parts of a capture. each has a `<stage>_ms` column in the timings table '''
+    # waiting for a worker thread
+    QUEUE='queue'
+    # capture service: waiting for a browser, then getting a page ready
+    BROWSER='browser'
+    CONTEXT='context'
+    # until domcontentloaded
+    NAVIGATE='navigate'
+    # from domcontentloaded until load, or until the page load timeout gave up on it
+    LOAD='load'
+    RENDER='render'
+    # encoding the screenshot and thumbnail
+    SCREENSHOT='screenshot'
+    # writing images to disk, or base64 encoding them for the response
+    SAVE='save'
+    VIEWS='views'
+    # time the request and response spent outside the capture service
+    TRANSPORT='transport'
+    # parsing the response and writing inline images
+    DECODE='decode'
+    # moving images into the image store
+    STORE='store'
+    # from queueing the result until the session writer committed it
+    COMMIT='commit'
+    # the whole capture, from leaving the queue until the result was queued for the session
+    TOTAL='total'
+    ALL = [QUEUE, BROWSER, CONTEXT, NAVIGATE, LOAD, RENDER, SCREENSHOT, SAVE, VIEWS, TRANSPORT, DECODE, STORE, COMMIT,
+           TOTAL]
+
+class CaptureTiming(TypedDict):
+    url: str
+    capture_pass: int
+    # Status the attempt ended with. QUEUED when the capture was lost and will be tried again
+    result: int
+    # error name and message for failed attempts
+    error_name: Optional[str]
+    error: Optional[str]
+    # the load event never fired and the screenshot was taken after domcontentloaded
+    load_fallback: bool
+    # milliseconds per Stage. stages that were not reached are missing
+    timings: dict[str, int]
+
+def normalize_url(u: str) -> str:
+    '''
+    Key used to decide if two URLs are the same page. The scheme's default port is made explicit,
+    slashes around the path are ignored and everything is compared case-insensitively.
+    '''
+    p = urllib.parse.urlparse(u.strip())
+    scheme = p.scheme.lower()
+    try:
+        port = p.port
+    except ValueError:
+        port = None
+    if port is None:
+        if scheme == 'http':
+            port = 80
+        elif scheme == 'https':
+            port = 443
+        else:
+            port = ''
+    return '{}://{}:{}/{}?{}'.format(scheme, p.hostname or '', port, p.path.strip('/'), p.query).lower()
+
+def _migrate_url_key(conn: sqlite3.Connection):
+    ''' index screens by normalized final URL '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(screens)')}
+    if 'url_key' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN url_key TEXT')
+    rows = conn.execute('SELECT id, url_final FROM screens WHERE url_key IS NULL').fetchall()
+    conn.executemany('UPDATE screens SET url_key = ? WHERE id = ?', [(normalize_url(r[1]), r[0]) for r in rows])
+    conn.execute('CREATE INDEX IF NOT EXISTS screens_url_key ON screens (url_key)')
+
+def _migrate_url_status(conn: sqlite3.Connection):
+    ''' page through urls by status without scanning the table '''
+    conn.execute('CREATE INDEX IF NOT EXISTS urls_status ON urls (status, id)')
+
+def _migrate_capture_pass(conn: sqlite3.Connection):
+    ''' record which pass and page timeout produced each screen '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(screens)')}
+    if 'pass' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN pass INTEGER DEFAULT 1')
+    if 'timeout_ms' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN timeout_ms INTEGER')
+
+def _migrate_duplicate_of(conn: sqlite3.Connection):
+    ''' link duplicate URLs to the URL that was captured in their place '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(urls)')}
+    if 'duplicate_of' not in columns:
+        conn.execute('ALTER TABLE urls ADD COLUMN duplicate_of TEXT')
+
+def _migrate_thumbnail(conn: sqlite3.Connection):
+    ''' small image shown in report tiles '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(screens)')}
+    if 'thumbnail' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN thumbnail TEXT')
+
+def _migrate_views(conn: sqlite3.Connection):
+    ''' extra screenshots of a screen taken from the same page load '''
+    conn.execute('''CREATE TABLE IF NOT EXISTS views
+    (id INTEGER PRIMARY KEY, url TEXT, name TEXT, image TEXT, UNIQUE(url, name))''')
+
+def _migrate_image_hash(conn: sqlite3.Connection):
+    ''' screens that share an identical image point at one stored copy '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(screens)')}
+    if 'image_hash' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN image_hash TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS screens_image_hash ON screens (image_hash)')
+
+def _migrate_phash(conn: sqlite3.Connection):
+    ''' perceptual hash of each image for visual clustering '''
+    columns = {r[1] for r in conn.execute('PRAGMA table_info(screens)')}
+    if 'phash' not in columns:
+        conn.execute('ALTER TABLE screens ADD COLUMN phash TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS screens_image ON screens (image)')
+
+def _migrate_timings(conn: sqlite3.Connection):
+    ''' how long each stage of every capture attempt took '''
+    conn.execute('''CREATE TABLE IF NOT EXISTS timings
+    (id INTEGER PRIMARY KEY, url TEXT, host TEXT, pass INTEGER, result INTEGER, error_name TEXT, error TEXT,
+    load_fallback INTEGER, created REAL, queue_ms INTEGER, browser_ms INTEGER, context_ms INTEGER,
+    navigate_ms INTEGER, load_ms INTEGER, render_ms INTEGER, screenshot_ms INTEGER, save_ms INTEGER,
+    views_ms INTEGER, transport_ms INTEGER, decode_ms INTEGER, store_ms INTEGER, commit_ms INTEGER,
+    total_ms INTEGER)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS timings_host ON timings (host)')
+
+# schema changes in order. PRAGMA user_version records how many have been applied to a session file.
+MIGRATIONS = [
+    _migrate_url_key,
+    _migrate_url_status,
+    _migrate_capture_pass,
+    _migrate_duplicate_of,
+    _migrate_thumbnail,
+    _migrate_views,
+    _migrate_image_hash,
+    _migrate_phash,
+    _migrate_timings,
+]
+
+# how long a connection waits on a locked database before giving up
+BUSY_TIMEOUT_S = 30
+
+class SessionWriter(threading.Thread):
+    '''
+    Owns the only connection that writes capture results. Records are queued by the workers and
+    committed together once `max_batch` records are waiting or the oldest has waited `max_delay`
+    seconds.
+    '''
+    STOP = object()
+    def __init__(self, session_file: str, max_batch: int=500, max_delay: float=0.25,
+                 on_commit=None):
+        super().__init__(name='session-writer', daemon=True)
+        self.session_file = session_file
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.on_commit = on_commit
+        self.queue = queue.Queue()
+    def submit(self, record: list[tuple[str, tuple]]):
+        ''' queue a record: statements that are committed together '''
+        self.queue.put((time.monotonic(), record))
+    def flush(self):
+        ''' block until everything queued so far is committed '''
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+    def close(self):
+        self.queue.put(self.STOP)
+        self.join()
+    def _next_batch(self) -> tuple[list, list, bool]:
+        ''' records come back as (time queued, statements) '''
+        records = []
+        waiters = []
+        item = self.queue.get()
+        deadline = time.monotonic() + self.max_delay
+        while True:
+            if item is self.STOP:
+                return records, waiters, True
+            if isinstance(item, threading.Event):
+                # commit now. someone is waiting on it
+                waiters.append(item)
+                return records, waiters, False
+            records.append(item)
+            if len(records) >= self.max_batch:
+                return records, waiters, False
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return records, waiters, False
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return records, waiters, False
+    def _commit(self, conn: sqlite3.Connection, records: list):
+        try:
+            with conn:
+                for _, record in records:
+                    for sql, params in record:
+                        conn.execute(sql, params)
+            return
+        except sqlite3.Error as e:
+            logger.error('Failed to commit %d session record(s), retrying one at a time: %s', len(records), str(e))
+        for _, record in records:
+            try:
+                with conn:
+                    for sql, params in record:
+                        conn.execute(sql, params)
+            except sqlite3.Error as e:
+                logger.error('Dropping session record %s: %s', record, str(e))
+    def run(self):
+        conn = sqlite3.connect(self.session_file, timeout=BUSY_TIMEOUT_S)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        stop = False
+        while not stop:
+            records, waiters, stop = self._next_batch()
+            if records:
+                self._commit(conn, records)
+                if self.on_commit:
+                    # records that wait on this commit, e.g. timings. written before anyone waiting
+                    # on a flush is released
+                    followup = [(time.monotonic(), record) for record in self.on_commit(records) or []]
+                    if followup:
+                        self._commit(conn, followup)
+            for w in waiters:
+                w.set()
+        conn.close()
 
 class WebShooterSession():
-    local = threading.local()
-    def __init__(self, session_file: str, urls: list[str]=[]):
+    INSERT_BATCH_SIZE = 10000
+    def __init__(self, session_file: str, urls: Iterable[str]=[]):
+        self.local = threading.local()
         self.connections = 0
         self.session_file = session_file
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        # normalized final URLs of screens queued but not yet committed. lets url_screen_exists see them
+        self.pending_keys: dict[str, str] = {}
+        self.pending_lock = threading.Lock()
+        # timings of screens queued but not yet committed, by URL. written once the commit time is known
+        self.pending_timings: dict[str, CaptureTiming] = {}
+        # called with every capture timing as it is written, e.g. by ScanMetrics
+        self.on_timing: Optional[Callable[[CaptureTiming], None]] = None
         if not os.path.exists(session_file):
             logger.info('Creating new session file: '+session_file)
         self._init_db(urls)
+    def __enter__(self) -> 'WebShooterSession':
+        return self
+    def __exit__(self, type, value, traceback):
+        self.close()
     def _get_conn(self) -> Any:
         if not getattr(self.local, 'conn', None):
-            self.local.conn = sqlite3.connect(self.session_file)
+            self.local.conn = sqlite3.connect(self.session_file, timeout=BUSY_TIMEOUT_S)
             self.connections += 1
         return self.local.conn
-    def _init_db(self, urls: list[str]):
+    def _get_writer(self) -> SessionWriter:
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = SessionWriter(self.session_file, on_commit=self._committed)
+                self.writer.start()
+                # make sure finished captures are written even if we exit without close()
+                atexit.register(self.close)
+            return self.writer
+    def _committed(self, records: list) -> list:
+        now = time.monotonic()
+        timings = []
+        with self.pending_lock:
+            for queued, record in records:
+                for sql, params in record:
+                    if sql == self.SQL_ADD_SCREEN:
+                        key, url = params[2], params[0]
+                        if self.pending_keys.get(key) == url:
+                            del self.pending_keys[key]
+                        timing = self.pending_timings.pop(url, None)
+                        if timing is not None:
+                            timing['timings'][Stage.COMMIT] = round((now - queued) * 1000)
+                            timings.append(timing)
+        if self.on_timing:
+            # timings of screens go out once their commit time is known
+            for t in timings:
+                self.on_timing(t)
+        if timings:
+            return [[(self.SQL_ADD_TIMING, self._timing_params(t)) for t in timings]]
+        return []
+    def flush(self):
+        ''' wait for queued writes to be committed '''
+        if self.writer is not None:
+            self.writer.flush()
+    def close(self):
+        ''' commit queued writes and stop the writer thread '''
+        with self.writer_lock:
+            writer, self.writer = self.writer, None
+        if writer is not None:
+            writer.close()
+            atexit.unregister(self.close)
+    def _init_db(self, urls: Iterable[str]):
         conn = self._get_conn()
+        # lets readers keep going while the writer commits
+        conn.execute('PRAGMA journal_mode=WAL')
         with conn:
             conn.execute('''CREATE TABLE IF NOT EXISTS urls
             (id INTEGER PRIMARY KEY, url TEXT, status INTEGER, UNIQUE(url))''')
             conn.execute('''CREATE TABLE IF NOT EXISTS screens
             (id INTEGER PRIMARY KEY, url TEXT, url_final TEXT, title TEXT, server TEXT, headers TEXT,
             status INTEGER, image TEXT, UNIQUE(url))''')
-            conn.executemany('INSERT OR IGNORE INTO urls (url, status) VALUES (?, ?)',
-                             [(u, Status.QUEUED) for u in urls])
-    def update_url(self, url: str, value: Status):
+            self._migrate(conn)
+        self.add_urls(urls)
+    def _migrate(self, conn: sqlite3.Connection):
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for i, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.debug('Upgrading session schema to version %d', i)
+            migration(conn)
+            conn.execute('PRAGMA user_version = {:d}'.format(i))
+    def add_urls(self, urls: Iterable[str]) -> int:
+        ''' queue `urls` in batches so large imports never sit in memory. returns the number added '''
         conn = self._get_conn()
-        with conn:
-            conn.execute('UPDATE urls SET status=? WHERE url=?', (value, url))
-    def add_screen(self, screen):
+        urls = iter(urls)
+        added = 0
+        while True:
+            batch = list(itertools.islice(urls, self.INSERT_BATCH_SIZE))
+            if len(batch) == 0:
+                return added
+            with conn:
+                before = conn.total_changes
+                conn.executemany('INSERT OR IGNORE INTO urls (url, status) VALUES (?, ?)',
+                                 [(u, Status.QUEUED) for u in batch])
+                added += conn.total_changes - before
+    SQL_UPDATE_URL = 'UPDATE urls SET status=? WHERE url=?'
+    SQL_SET_PHASH = 'UPDATE screens SET phash=? WHERE image=?'
+    SQL_ADD_VIEW = 'INSERT OR IGNORE INTO views (url, name, image) VALUES (?, ?, ?)'
+    SQL_MARK_DUPLICATE = 'UPDATE urls SET status=?, duplicate_of=? WHERE url=?'
+    SQL_ADD_TIMING = '''INSERT INTO timings
+            (url, host, pass, result, error_name, error, load_fallback, created, {})
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, {})'''.format(', '.join(s + '_ms' for s in Stage.ALL),
+                                                           ', '.join('?' * len(Stage.ALL)))
+    SQL_PASS_TIMEOUTS = 'SELECT url FROM timings WHERE pass = ? AND result = ? AND created >= ?'
+    SQL_ADD_SCREEN = '''INSERT OR IGNORE INTO screens
+            (url, url_final, url_key, title, server, headers, status, image, pass, timeout_ms, thumbnail, image_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    def update_url(self, url: str, value: Status):
+        ''' queued. committed by the writer thread '''
+        self._get_writer().submit([(self.SQL_UPDATE_URL, (value, url))])
+    def update_urls(self, urls: list[str], value: Status):
+        ''' committed before returning '''
+        writer = self._get_writer()
+        for u in urls:
+            writer.submit([(self.SQL_UPDATE_URL, (value, u))])
+        writer.flush()
+    def mark_duplicate(self, url: str, duplicate_of: Optional[str]):
+        ''' queued. committed by the writer thread '''
+        self._get_writer().submit([(self.SQL_MARK_DUPLICATE, (Status.DUPLICATE, duplicate_of, url))])
+    def mark_duplicates(self, pairs: Iterable[tuple[str, str]]):
+        ''' mark each (url, duplicate_of) pair. committed before returning '''
+        writer = self._get_writer()
+        for url, duplicate_of in pairs:
+            writer.submit([(self.SQL_MARK_DUPLICATE, (Status.DUPLICATE, duplicate_of, url))])
+        writer.flush()
+    def _timing_params(self, timing: CaptureTiming) -> tuple:
+        timings = timing['timings']
+        return (timing['url'], (urllib.parse.urlparse(timing['url']).netloc or '').lower(), timing['capture_pass'],
+                timing['result'], timing.get('error_name'), timing.get('error'), int(bool(timing.get('load_fallback'))),
+                time.time(), *[timings.get(s) for s in Stage.ALL])
+    def add_timing(self, timing: CaptureTiming):
+        ''' queued. committed by the writer thread '''
+        self._get_writer().submit([(self.SQL_ADD_TIMING, self._timing_params(timing))])
+        if self.on_timing:
+            self.on_timing(timing)
+    def write_queue_size(self) -> int:
+        ''' records waiting for the writer thread '''
+        writer = self.writer
+        return writer.queue.qsize() if writer is not None else 0
+    def add_screen(self, screen, timing: CaptureTiming=None):
+        '''
+        queued. committed by the writer thread. `timing` is written after the screen, once the
+        time to commit it is known
+        '''
+        key = normalize_url(screen['url_final'])
+        writer = self._get_writer()
+        with self.pending_lock:
+            self.pending_keys.setdefault(key, screen['url'])
+            if timing is not None:
+                self.pending_timings[screen['url']] = timing
+        writer.submit([
+            (self.SQL_ADD_SCREEN, (screen['url'], screen['url_final'], key, screen['title'],
+                                   screen['server'], screen['headers'], screen['status'], screen['image'],
+                                   screen.get('pass', 1), screen.get('timeout_ms'), screen.get('thumbnail'),
+                                   screen.get('image_hash'))),
+            *[(self.SQL_ADD_VIEW, (screen['url'], name, image)) for name, image in screen.get('views', {}).items()],
+            (self.SQL_UPDATE_URL, (Status.FINISHED, screen['url']))
+        ])
+    def get_unhashed_images(self) -> list[tuple[str, str]]:
+        ''' (image, thumbnail) for every distinct image without a perceptual hash '''
         conn = self._get_conn()
-        with conn:
-            conn.execute('''INSERT OR IGNORE INTO screens
-            (url, url_final, title, server, headers, status, image)
-            VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                         (screen['url'], screen['url_final'], screen['title'], screen['server'],
-                          screen['headers'], screen['status'], screen['image']))
-            conn.execute('UPDATE urls SET status = ? WHERE url = ?', (Status.FINISHED, screen['url']))
+        return conn.execute('SELECT image, MAX(thumbnail) FROM screens WHERE phash IS NULL GROUP BY image').fetchall()
+    def set_image_hashes(self, pairs: Iterable[tuple[str, str]]):
+        ''' store an (image, phash) pair for every screen showing that image. committed before returning '''
+        self._get_writer().submit([(self.SQL_SET_PHASH, (phash, image)) for image, phash in pairs])
+        self.flush()
     def url_screen_exists(self, url_final: str):
+        key = normalize_url(url_final)
+        with self.pending_lock:
+            if key in self.pending_keys:
+                return (self.pending_keys[key],)
         conn = self._get_conn()
         with conn:
-            cur = conn.execute('SELECT url FROM screens WHERE url_final = ? COLLATE NOCASE', (url_final,))
+            cur = conn.execute('SELECT url FROM screens WHERE url_key = ?', (key,))
             return cur.fetchone()
+    def iter_urls(self, statuses: list[Status], page_size: int=1000) -> Iterator[str]:
+        '''
+        Stream URLs with any of `statuses` a page at a time, in the order they were added. Pages
+        are keyed on the row id so URLs updated while iterating are neither skipped nor repeated.
+        '''
+        conn = self._get_conn()
+        marks = ','.join('?' * len(statuses))
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, url FROM urls WHERE status IN ({}) AND id > ? ORDER BY id LIMIT ?'.format(marks),
+                                (*statuses, last_id, page_size)).fetchall()
+            if len(rows) == 0:
+                return
+            last_id = rows[-1][0]
+            for r in rows:
+                yield r[1]
+    def count_urls(self, statuses: list[Status]) -> int:
+        conn = self._get_conn()
+        marks = ','.join('?' * len(statuses))
+        return conn.execute('SELECT COUNT(*) FROM urls WHERE status IN ({})'.format(marks), statuses).fetchone()[0]
+    def iter_pass_timeouts(self, capture_pass: int, since: float, page_size: int=1000) -> Iterator[str]:
+        '''
+        Stream URLs that timed out in `capture_pass` of the scan started at `since` (a time.time()
+        value) and have not been captured since. Timeouts left over from earlier scans are skipped.
+        '''
+        conn = self._get_conn()
+        last_id = 0
+        while True:
+            rows = conn.execute('SELECT id, url FROM urls WHERE status = ? AND id > ? AND url IN ({}) ORDER BY id LIMIT ?'.format(
+                                    self.SQL_PASS_TIMEOUTS), (Status.TIMEOUT, last_id, capture_pass, Status.TIMEOUT, since,
+                                                              page_size)).fetchall()
+            if len(rows) == 0:
+                return
+            last_id = rows[-1][0]
+            for r in rows:
+                yield r[1]
+    def count_pass_timeouts(self, capture_pass: int, since: float) -> int:
+        conn = self._get_conn()
+        return conn.execute('SELECT COUNT(*) FROM urls WHERE status = ? AND url IN ({})'.format(self.SQL_PASS_TIMEOUTS),
+                            (Status.TIMEOUT, capture_pass, Status.TIMEOUT, since)).fetchone()[0]
     def get_queued_urls(self) -> list[str]:
         conn = self._get_conn()
         cursor = conn.execute('SELECT * FROM urls WHERE status = ?', (Status.QUEUED,))
         return [r[1] for r in cursor.fetchall()]
     def get_failed_urls(self) -> list[str]:
         conn = self._get_conn()
-        cursor = conn.execute('SELECT * FROM urls WHERE status = ?', (Status.ERROR,))
+        cursor = conn.execute('SELECT * FROM urls WHERE status IN (?, ?)', (Status.ERROR, Status.TIMEOUT))
         return [r[1] for r in cursor.fetchall()]
-    def _normalize_url(self, u: str, ignore_params: bool=False) -> str:
-        p = urllib.parse.urlparse(u)
-        port = p.port
-        if port is None:
-            if p.scheme.lower() == 'http':
-                port = 80
-            elif p.scheme.lower() == 'https':
-                port = 443
-            else:
-                port = ''
-        return '{}://{}:{}/{}?{}'.format(p.scheme, p.hostname, port, p.path.strip('/'), '' if ignore_params else p.query)
-    def get_results(self, ignore_errors: bool=False, unique: bool=True) -> list[dict[str, Any]]:
-        conn = self._get_conn()
+    def _results_where(self, ignore_errors: bool, unique: bool) -> str:
+        where = []
+        status = 'status >= 200 AND status < 400'
         if ignore_errors:
-            cursor = conn.execute('SELECT url, url_final, title, server, headers, status, image FROM screens WHERE status >= 200 AND status < 400 ORDER BY title, server ASC')
-        else:
-            cursor = conn.execute('SELECT url, url_final, title, server, headers, status, image FROM screens ORDER BY title, server ASC')
-
-        results = [{
-            'url': r[0], 'url_final': r[1], 'title': r[2], 'server': r[3], 'headers': json.loads(r[4]),
-            'status': r[5], 'image': r[6]
-        } for r in cursor.fetchall()]
+            where.append(status)
         if unique:
+            # keep the latest screen for each normalized final URL. drop errors first so an older
+            # good screen is kept over a newer error
             # XXX there is an issue here because mobile emulation may result in a final url of "about:blank"
-            uniq = {self._normalize_url(r['url_final']): r for r in results}
-            results = uniq.values()
-        return results
+            where.append('id IN (SELECT MAX(id) FROM screens{} GROUP BY url_key)'.format(
+                ' WHERE ' + status if ignore_errors else ''))
+        return (' WHERE ' + ' AND '.join(where)) if where else ''
+    def count_results(self, ignore_errors: bool=False, unique: bool=True) -> int:
+        conn = self._get_conn()
+        return conn.execute('SELECT COUNT(*) FROM screens' + self._results_where(ignore_errors, unique)).fetchone()[0]
+    def iter_results(self, ignore_errors: bool=False, unique: bool=True, batch_size: int=500) -> Iterator[dict[str, Any]]:
+        '''
+        Stream results sorted by title, or by Server header when there is no title, like the report.
+        Only `batch_size` rows are held at a time. SQLite lowercases ASCII only, so non-ASCII titles
+        may sort slightly differently than Python would.
+        '''
+        conn = self._get_conn()
+        where = self._results_where(ignore_errors, unique)
+        # how many results show each byte-identical screenshot. only images shared by several are kept
+        shared = dict(conn.execute('SELECT image_hash, COUNT(*) FROM screens' + where +
+                                   (' AND' if where else ' WHERE') + ' image_hash IS NOT NULL'
+                                   ' GROUP BY image_hash HAVING COUNT(*) > 1').fetchall())
+        cursor = conn.execute('SELECT url, url_final, title, server, headers, status, image, thumbnail, image_hash, phash'
+                              ' FROM screens' + where +
+                              " ORDER BY lower(CASE WHEN title != '' THEN title ELSE COALESCE(server, '') END), id")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                return
+            results = [{
+                'url': r[0], 'url_final': r[1], 'title': r[2], 'server': r[3], 'headers': json.loads(r[4]),
+                'status': r[5], 'image': r[6], 'thumbnail': r[7], 'image_hash': r[8], 'phash': r[9],
+                'views': {}, 'shared': shared.get(r[8], 1)
+            } for r in rows]
+            by_url = {r['url']: r for r in results}
+            marks = ','.join('?' * len(by_url))
+            for url, name, image in conn.execute('SELECT url, name, image FROM views WHERE url IN ({}) ORDER BY id'.format(marks),
+                                                 list(by_url)):
+                by_url[url]['views'][name] = image
+            yield from results
+    def get_results(self, ignore_errors: bool=False, unique: bool=True) -> list[dict[str, Any]]:
+        return list(self.iter_results(ignore_errors, unique))
+    def count_timings(self) -> dict[int, int]:
+        ''' capture attempts by the Status they ended with '''
+        conn = self._get_conn()
+        return dict(conn.execute('SELECT result, COUNT(*) FROM timings GROUP BY result').fetchall())
+    def get_stage_times(self, stage: str, result: Status=Status.FINISHED) -> list[int]:
+        ''' sorted milliseconds spent in `stage` by attempts that ended with `result` '''
+        if stage not in Stage.ALL:
+            raise ValueError('unknown stage: ' + stage)
+        conn = self._get_conn()
+        column = stage + '_ms'
+        return [r[0] for r in conn.execute('SELECT {0} FROM timings WHERE result = ? AND {0} IS NOT NULL ORDER BY {0}'.format(column),
+                                           (result,))]
+    def get_slow_hosts(self, limit: int=10) -> list[tuple[str, int, float, int, int]]:
+        ''' (host, attempts, mean total ms, max total ms, failed attempts) for the hosts with the slowest captures '''
+        conn = self._get_conn()
+        return conn.execute('SELECT host, COUNT(*), AVG(total_ms), MAX(total_ms), SUM(result IN (?, ?)) FROM timings'
+                            ' GROUP BY host ORDER BY AVG(total_ms) DESC LIMIT ?',
+                            (Status.ERROR, Status.TIMEOUT, limit)).fetchall()
+    def get_timing_errors(self) -> list[tuple[int, str, int, str]]:
+        ''' (result, error name, attempts, an example message) for failed attempts, most common first '''
+        conn = self._get_conn()
+        return conn.execute('SELECT result, error_name, COUNT(*), MAX(error) FROM timings WHERE error_name IS NOT NULL'
+                            ' GROUP BY result, error_name ORDER BY COUNT(*) DESC').fetchall()
+    def count_load_fallbacks(self) -> int:
+        conn = self._get_conn()
+        return conn.execute('SELECT COUNT(*) FROM timings WHERE load_fallback = 1').fetchone()[0]
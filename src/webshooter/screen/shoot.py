@@ -1,13 +1,17 @@
 import os
 import json
-import base64
+import time
 import logging
-import tempfile
 import urllib.parse
 import concurrent.futures
+from collections.abc import Iterable
 
-from webshooter.screen.session import Status, WebShooterSession
-from webshooter.screen.capture import CaptureClient, CaptureError
+from webshooter.screen.session import Status, Stage, CaptureTiming, WebShooterSession
+from webshooter.screen.capture import CaptureClient, CaptureError, CaptureTimeout, CaptureUnavailable, ImageFormat
+from webshooter.screen.schedule import HostScheduler
+from webshooter.screen.store import ImageStore
+from webshooter.screen.concurrency import ConcurrencyController
+from webshooter.screen.metrics import ScanMetrics
 
 logger = logging.getLogger(__package__)
 
@@ -23,41 +27,130 @@ def image_name_from_url(url: str) -> str:
             port = 443
     return '{}-{}-{}'.format(u.scheme, host, port).replace('/', '').replace('\\', '')
 
-def shoot_thread(url: str, client: CaptureClient, session: WebShooterSession):
+def remove_image(img_file: str):
+    try:
+        os.remove(img_file)
+    except OSError as e:
+        logger.debug('Failed to remove {}: {}'.format(img_file, str(e)))
+
+def remove_images(*img_files: str):
+    for img_file in img_files:
+        if img_file:
+            remove_image(img_file)
+
+def thumbnail_name(img_file: str, image_format: str) -> str:
+    return os.path.splitext(img_file)[0] + '.thumb' + ImageFormat.EXTENSIONS[ImageFormat.thumbnail(image_format)]
+
+def view_name(img_file: str, view: str) -> str:
+    base, ext = os.path.splitext(img_file)
+    return '{}.{}{}'.format(base, view, ext)
+
+def store_images(store: ImageStore, page_info: dict, img_file: str, thumb_file: str,
+                 view_files: dict[str, str]) -> tuple[str, str, dict[str, str]]:
+    ''' move a capture's files into the store. returns the stored image, thumbnail and views '''
+    image = store.put(img_file, page_info.get('image_sha256') or None)
+    thumbnail = None
+    if thumb_file and page_info.get('thumbnail_size'):
+        # a thumbnail only depends on its image so it shares the image's hash
+        thumbnail = store.put(thumb_file, name=os.path.splitext(os.path.basename(image))[0] + '.thumb')
+    else:
+        remove_images(thumb_file)
+    views = {}
+    for v in page_info.get('views', []):
+        if v['name'] in view_files:
+            views[v['name']] = store.put(view_files.pop(v['name']), v.get('image_sha256') or None)
+    remove_images(*view_files.values())
+    return image, thumbnail, views
+
+def elapsed_ms(start: float) -> int:
+    return round((time.monotonic() - start) * 1000)
+
+def shoot_thread(url: str, client: CaptureClient, session: WebShooterSession, capture_pass: int=1,
+                 store: ImageStore=None, queued_at: float=None) -> Status:
+    '''
+    capture `url` and return the status recorded for it. images are kept in `store`. how long each
+    stage took is recorded in the session, including the wait since `queued_at`
+    '''
+    start = time.monotonic()
+    store = store or ImageStore()
+    timing: CaptureTiming = {'url': url, 'capture_pass': capture_pass, 'result': Status.ERROR, 'error_name': None,
+                             'error': None, 'load_fallback': False, 'timings': {}}
+    if queued_at is not None:
+        timing['timings'][Stage.QUEUE] = round((start - queued_at) * 1000)
+    def failed(result: Status, e: Exception) -> Status:
+        if isinstance(e, CaptureError):
+            timing['timings'].update(e.timings)
+            timing['error_name'] = e.name
+        else:
+            timing['error_name'] = type(e).__name__
+        timing['error'] = str(e)
+        timing['result'] = result
+        timing['timings'][Stage.TOTAL] = elapsed_ms(start)
+        session.add_timing(timing)
+        return result
     # Handle case where a URL was already captured. We dedupe URLs before attempting screenshots but
     # another URL that was captured in this run may have redirected to this URL.
-    if session.url_screen_exists(url):
+    existing = session.url_screen_exists(url)
+    if existing:
         logger.info('Already got a screenshot of {}'.format(url))
-        session.update_url(url, Status.DUPLICATE)
-        return
+        session.mark_duplicate(url, existing[0] if existing[0] != url else None)
+        return Status.DUPLICATE
+
+    # reserve a file name for the screenshot. the capture service writes the image straight to it.
+    # names for the thumbnail and extra views are derived from it so they are unique too
+    image_format = client.image_format
+    thumb_file = None
+    try:
+        img_file = store.reserve(image_name_from_url(url)+'.', ImageFormat.EXTENSIONS[image_format])
+        if client.thumbnail_width > 0:
+            thumb_file = thumbnail_name(img_file, image_format)
+        view_files = {v: view_name(img_file, v) for v in client.views}
+    except Exception as e:
+        logger.error('Failed to create screenshot file: '+str(e))
+        session.update_url(url, Status.ERROR)
+        return Status.ERROR
 
     # get screenshot
     headers = {}
 
     logger.info('Taking screenshot: '+url)
     try:
-        page_info = client.capture(url, headers)
+        page_info = client.capture(url, headers, img_file, thumb_file, view_files)
+    except CaptureUnavailable as e:
+        # the browser or service died under this capture. leave it queued so it can be retried
+        logger.warning('Capture service unavailable for {}: {}'.format(url, str(e)))
+        remove_images(img_file, thumb_file, *view_files.values())
+        return failed(Status.QUEUED, e)
+    except CaptureTimeout as e:
+        logger.error('Timed out taking screenshot for {}: {}'.format(url, str(e)))
+        remove_images(img_file, thumb_file, *view_files.values())
+        session.update_url(url, Status.TIMEOUT)
+        return failed(Status.TIMEOUT, e)
     except CaptureError as e:
         logger.error('Failed to take screenshot for {}: {}'.format(url, str(e)))
+        remove_images(img_file, thumb_file, *view_files.values())
         session.update_url(url, Status.ERROR)
-        return
+        return failed(Status.ERROR, e)
 
+    timing['timings'].update(page_info.get('timings', {}))
+    timing['load_fallback'] = page_info.get('load_fallback', False)
     url_final = page_info['url_final']
+    logger.debug('Waited {} ms for {} to render'.format(page_info.get('render_wait_ms', -1), url))
+    counters = page_info.get('requests')
+    if counters and counters['blocked']:
+        logger.debug('Blocked {} of {} request(s) for {}: {}'.format(
+            counters['blocked'], counters['blocked'] + counters['requests'], url, counters['blocked_by']))
     if url != url_final:
         logger.debug('Redirected: {} -> {}'.format(url, url_final))
-    if session.url_screen_exists(url_final):
+    existing = session.url_screen_exists(url_final)
+    if existing:
         logger.info('Already got a screenshot of {}'.format(url_final))
-        session.update_url(url, Status.DUPLICATE)
-        return
-
-    try:
-        with tempfile.NamedTemporaryFile(prefix=image_name_from_url(url)+'.', suffix='.png', dir='.', delete=False) as fp:
-            img_file = fp.name
-            fp.write(base64.b64decode(page_info['image']))
-    except Exception as e:
-        logger.error('Failed to save screenshot: '+str(e))
-        session.update_url(url, Status.ERROR)
-        return
+        remove_images(img_file, thumb_file, *view_files.values())
+        session.mark_duplicate(url, existing[0])
+        timing['result'] = Status.DUPLICATE
+        timing['timings'][Stage.TOTAL] = elapsed_ms(start)
+        session.add_timing(timing)
+        return Status.DUPLICATE
 
     title = page_info.get('title', '')
     server = page_info['headers'].get('server', '')
@@ -66,43 +159,136 @@ def shoot_thread(url: str, client: CaptureClient, session: WebShooterSession):
 
     logger.debug('[{}] GET {} : title="{}", server="{}"'.format(status, url_final, title, server))
 
+    stored = time.monotonic()
+    try:
+        image, thumbnail, views = store_images(store, page_info, img_file, thumb_file, view_files)
+    except OSError as e:
+        logger.error('Failed to store screenshot for {}: {}'.format(url, str(e)))
+        remove_images(img_file, thumb_file, *view_files.values())
+        session.update_url(url, Status.ERROR)
+        return failed(Status.ERROR, e)
+    timing['timings'][Stage.STORE] = elapsed_ms(stored)
+
     screen = {
         'url': url,
         'url_final': url_final,
         'title': title,
         'server': server,
         'status': status,
-        'image': os.path.basename(img_file),
+        'image': image,
+        'image_hash': os.path.splitext(os.path.basename(image))[0],
+        'thumbnail': thumbnail,
+        'views': views,
+        'pass': capture_pass,
+        'timeout_ms': page_info.get('timeout_ms'),
         'headers': json.dumps(list(sorted(headers, key=lambda h: h[0]))) # alphabetic sort on header name
     }
 
+    timing['result'] = Status.FINISHED
+    timing['timings'][Stage.TOTAL] = elapsed_ms(start)
     try:
-        session.add_screen(screen)
+        session.add_screen(screen, timing)
     except Exception as e:
         logger.error('Failed to add screenshot: '+str(e))
+        return Status.ERROR
+    return Status.FINISHED
 
 
-def shoot_thread_wrapper(url: str, client: CaptureClient, session: WebShooterSession):
+def shoot_thread_wrapper(url: str, client: CaptureClient, session: WebShooterSession, capture_pass: int=1,
+                         store: ImageStore=None, queued_at: float=None) -> Status:
     try:
-        shoot_thread(url, client, session)
+        return shoot_thread(url, client, session, capture_pass, store, queued_at)
     except Exception as e:
         logger.error('Failed on {}: {}'.format(url, str(e)))
         session.update_url(url, Status.ERROR)
+        return Status.ERROR
+
+# captures queued per worker. keeps workers busy without materializing every URL
+QUEUE_DEPTH = 2
+PROGRESS_INTERVAL_S = 10
+# tries per URL when the capture service goes away under it, and the wait before each retry
+MAX_ATTEMPTS = 3
+RETRY_DELAY_S = 5
 
-def capture_from_urls(urls: list[str], threads: int, session: WebShooterSession, client: CaptureClient):
-    if len(urls) == 0:
-        return
-    threads = min(threads, len(urls))
+def capture_from_urls(urls: Iterable[str], threads: int, session: WebShooterSession, client: CaptureClient, total: int=None,
+                      capture_pass: int=1, controller: ConcurrencyController=None, store: ImageStore=None,
+                      metrics: ScanMetrics=None):
+    '''
+    Capture `urls` with `threads` workers. `urls` may be a HostScheduler to limit captures per
+    host, otherwise URLs are just interleaved across hosts. URLs are pulled only as workers free
+    up, so memory use does not depend on how many there are. Returns False if aborted.
 
-    work = []
+    With a `controller`, `threads` is only the size of the worker pool and the controller decides
+    how many captures run at once.
+
+    URLs whose capture was lost to a browser crash or service restart are retried after
+    RETRY_DELAY_S, up to MAX_ATTEMPTS times. Images go to `store`, ./images by default. Progress is
+    reported to `metrics` if given.
+    '''
+    store = store or ImageStore()
+    if isinstance(urls, HostScheduler):
+        schedule = urls
+    else:
+        schedule = HostScheduler(urls, lookahead=max(1000, threads * 100))
+    if controller:
+        threads = controller.ceiling
+    max_in_flight = threads * QUEUE_DEPTH
+    finished = 0
+    last_progress = time.monotonic()
     logger.debug('Scanning with {} worker(s)'.format(threads))
     with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as e:
-        work = [e.submit(shoot_thread_wrapper, u, client, session) for u in urls]
-        logger.debug('Waiting for workers to finish')
+        work = {}
+        started = {}
+        attempts = {}
         try:
-            while len(work):
-                _, work = concurrent.futures.wait(work, timeout=1.0)
+            while True:
+                if controller:
+                    max_in_flight = controller.adjust()
+                while len(work) < max_in_flight:
+                    u = schedule.next()
+                    if u is None:
+                        break
+                    started_at = time.monotonic()
+                    w = e.submit(shoot_thread_wrapper, u, client, session, capture_pass, store, started_at)
+                    work[w] = u
+                    started[w] = started_at
+                if controller:
+                    controller.in_flight(len(work))
+                if metrics:
+                    metrics.progress(max(0, total - finished - len(work)) if total is not None else 0, len(work),
+                                     controller.limit if controller else None, session.write_queue_size())
+                if len(work) == 0:
+                    if schedule.finished():
+                        break
+                    # every waiting host is held back by its spacing
+                    time.sleep(0.05)
+                    continue
+                done, _ = concurrent.futures.wait(work, timeout=0.25, return_when=concurrent.futures.FIRST_COMPLETED)
+                for w in done:
+                    u = work.pop(w)
+                    schedule.done(u)
+                    start = started.pop(w)
+                    result = None if w.cancelled() else w.result()
+                    if result == Status.QUEUED:
+                        attempts[u] = attempts.get(u, 1) + 1
+                        if attempts[u] <= MAX_ATTEMPTS:
+                            schedule.requeue(u, RETRY_DELAY_S)
+                            continue
+                        logger.error('Giving up on {} after {} attempts'.format(u, MAX_ATTEMPTS))
+                        session.update_url(u, Status.ERROR)
+                        result = Status.ERROR
+                    attempts.pop(u, None)
+                    if controller and result is not None:
+                        controller.record(time.monotonic() - start, result in (Status.ERROR, Status.TIMEOUT))
+                    if metrics:
+                        metrics.finished()
+                    finished += 1
+                if time.monotonic() - last_progress >= PROGRESS_INTERVAL_S:
+                    last_progress = time.monotonic()
+                    logger.info('Finished {}{} URL(s)'.format(finished, '' if total is None else '/{}'.format(total)))
         except KeyboardInterrupt:
             print('Aborting! Cancelling workers...')
             for w in work:
                 w.cancel()
+            return False
+    return True
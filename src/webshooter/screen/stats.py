@@ -0,0 +1,66 @@
+import logging
+from typing import Any, Optional
+
+from webshooter.screen.session import Status, Stage, WebShooterSession
+
+logger = logging.getLogger(__package__)
+
+PERCENTILES = [50, 90, 99]
+STATUS_NAMES = {Status.QUEUED: 'lost', Status.FINISHED: 'finished', Status.ERROR: 'error', Status.INVALID: 'invalid',
+                Status.DUPLICATE: 'duplicate', Status.TIMEOUT: 'timeout'}
+
+def percentile(values: list[int], p: float) -> Optional[int]:
+    ''' nearest-rank percentile of sorted `values` '''
+    if len(values) == 0:
+        return None
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+def summarize(session: WebShooterSession, hosts: int=10) -> dict[str, Any]:
+    '''
+    Where the time went in the captures recorded in `session`: percentiles per Stage over
+    finished captures, the hosts with the slowest captures and the most common errors.
+    Lost attempts ended with the capture service going away and were tried again.
+    '''
+    stages = {}
+    for stage in Stage.ALL:
+        values = session.get_stage_times(stage)
+        if values:
+            stages[stage] = {'count': len(values), 'mean': round(sum(values) / len(values)),
+                             **{'p{}'.format(p): percentile(values, p) for p in PERCENTILES}, 'max': values[-1]}
+    return {
+        'attempts': {STATUS_NAMES.get(k, str(k)): v for k, v in session.count_timings().items()},
+        'load_fallbacks': session.count_load_fallbacks(),
+        'stages': stages,
+        'slowest_hosts': [{'host': h, 'attempts': n, 'mean_ms': round(mean or 0), 'max_ms': top, 'failed': failed}
+                          for h, n, mean, top, failed in session.get_slow_hosts(hosts)],
+        'errors': [{'result': STATUS_NAMES.get(result, str(result)), 'name': name, 'count': n, 'example': example}
+                   for result, name, n, example in session.get_timing_errors()]
+    }
+
+def format_summary(summary: dict[str, Any]) -> str:
+    lines = []
+    attempts = summary['attempts']
+    lines.append('Capture attempts: {} ({})'.format(
+        sum(attempts.values()), ', '.join('{} {}'.format(n, k) for k, n in sorted(attempts.items())) or 'none recorded'))
+    lines.append('Screenshots taken after domcontentloaded because load never fired: {}'.format(summary['load_fallbacks']))
+    if summary['stages']:
+        lines.append('')
+        columns = ['count', 'mean'] + ['p{}'.format(p) for p in PERCENTILES] + ['max']
+        lines.append('{:<12}'.format('stage (ms)') + ''.join('{:>10}'.format(c) for c in columns))
+        for stage, s in summary['stages'].items():
+            lines.append('{:<12}'.format(stage) + ''.join('{:>10}'.format(s[c]) for c in columns))
+    if summary['slowest_hosts']:
+        lines.append('')
+        lines.append('{:<40}{:>10}{:>10}{:>10}{:>10}'.format('slowest hosts', 'attempts', 'mean ms', 'max ms', 'failed'))
+        for h in summary['slowest_hosts']:
+            lines.append('{:<40}{:>10}{:>10}{:>10}{:>10}'.format(h['host'][:39], h['attempts'], h['mean_ms'],
+                                                                 h['max_ms'] if h['max_ms'] is not None else '-',
+                                                                 h['failed']))
+    if summary['errors']:
+        lines.append('')
+        lines.append('{:<10}{:<24}{:>8}  {}'.format('result', 'error', 'count', 'example'))
+        for e in summary['errors']:
+            lines.append('{:<10}{:<24}{:>8}  {}'.format(e['result'], (e['name'] or '')[:23], e['count'],
+                                                        (e['example'] or '').splitlines()[0][:80] if e['example'] else ''))
+    return '\n'.join(lines)
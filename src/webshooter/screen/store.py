@@ -0,0 +1,46 @@
+import os
+import hashlib
+import logging
+import tempfile
+from typing import Optional
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_ROOT = 'images'
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(2**20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class ImageStore():
+    '''
+    Screenshots stored once per unique content as `<root>/<sha256><ext>`. Captures are written to a
+    reserved temporary name in the store and then moved to their hash, or dropped if an identical
+    image is already there. Files keep their names forever so nothing has to be locked.
+    '''
+    def __init__(self, root: str=DEFAULT_ROOT):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+    def reserve(self, prefix: str, suffix: str) -> str:
+        ''' create an empty file for a capture to be written to '''
+        with tempfile.NamedTemporaryFile(prefix=prefix, suffix=suffix, dir=self.root, delete=False) as fp:
+            return fp.name
+    def path(self, digest: str, ext: str) -> str:
+        return os.path.join(self.root, digest + ext)
+    def put(self, temp_file: str, digest: Optional[str]=None, name: Optional[str]=None) -> str:
+        '''
+        Move `temp_file` to its place in the store and return the new path. The name is the
+        image's SHA-256 unless `name` is given, e.g. for a thumbnail named after its full image.
+        '''
+        ext = os.path.splitext(temp_file)[1]
+        dest = self.path(name or digest or file_sha256(temp_file), ext)
+        if os.path.exists(dest):
+            logger.debug('Already stored %s', dest)
+            os.remove(temp_file)
+        else:
+            # another worker may store the same image at the same time. either copy is fine
+            os.replace(temp_file, dest)
+        return dest
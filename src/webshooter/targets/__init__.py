@@ -1,3 +1,6 @@
+from . import workers
 from . import nmap
 from . import nessus
-from . import urls
\ No newline at end of file
+from . import urls
+from . import probe
+from . import redirects
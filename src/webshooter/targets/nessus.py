@@ -1,23 +1,32 @@
-from collections.abc import Collection
+from collections.abc import Collection, Iterator
 import xml.etree.ElementTree as ET
 
-def from_xml(xml_file: str, http_ports: Collection[int], https_ports: Collection[int]) -> set[str]:
-    scan = ET.parse(xml_file).getroot()
+from webshooter.targets.urls import from_host_port
+
+def from_xml(xml_file: str, http_ports: Collection[int], https_ports: Collection[int]) -> Iterator[str]:
+    '''
+    Stream URLs for the tcp ports in a .nessus file. Each ReportHost is discarded once it has
+    been read so memory does not grow with the size of the file.
+    '''
+    events = ET.iterparse(xml_file, events=('start', 'end'))
+    _, scan = next(events)
     if not scan.tag == 'NessusClientData_v2':
         raise ValueError('xml file is not NessusClientData_v2 format')
-    urls = set()
-    for report_host in scan.iterfind('./Report/ReportHost'):
-        host: str = report_host.get('name')
-        for report_item in report_host.iterfind('./ReportItem[@protocol="tcp"]'):
-            port: int = int(report_item.get('port'))
-            if port in http_ports:
-                if port == 80:
-                    urls.add('http://{}/'.format(host))
-                else:
-                    urls.add('http://{}:{}/'.format(host, port))
-            if port in https_ports:
-                if port == 443:
-                    urls.add('https://{}/'.format(host))
-                else:
-                    urls.add('https://{}:{}/'.format(host, port))
-    return urls
+    report = None
+    for event, elem in events:
+        if event == 'start':
+            if elem.tag == 'Report':
+                report = elem
+            continue
+        if elem.tag == 'ReportHost':
+            host: str = elem.get('name')
+            ports = {int(item.get('port')) for item in elem.iterfind('./ReportItem[@protocol="tcp"]')}
+            for port in sorted(ports):
+                if port in http_ports:
+                    yield from_host_port('http', host, port)
+                if port in https_ports:
+                    yield from_host_port('https', host, port)
+            if report is not None:
+                report.clear()
+        elif elem.tag == 'Policy':
+            scan.clear()
@@ -1,28 +1,57 @@
-from collections.abc import Collection
+from collections.abc import Collection, Iterator
 import xml.etree.ElementTree as ET
 
-def from_xml(xml_file: str, http_ports: Collection[int], https_ports: Collection[int]) -> set[str]:
-    scan = ET.parse(xml_file).getroot()
+from webshooter.targets.urls import from_host_port
+
+# nmap service names that mean a web server
+HTTP_SERVICES = {'http', 'http-alt', 'http-proxy', 'http-mgmt', 'https', 'https-alt', 'ssl/http', 'ssl/https'}
+
+def _service_schemes(port: ET.Element) -> set[str]:
+    ''' schemes implied by the service nmap detected on `port` '''
+    service = port.find('service')
+    if service is None:
+        return set()
+    name = service.get('name', '').lower()
+    if name not in HTTP_SERVICES:
+        return set()
+    if service.get('tunnel') == 'ssl' or name.startswith('https') or name.startswith('ssl/'):
+        return {'https'}
+    return {'http'}
+
+def _host_urls(host: ET.Element, http_ports: Collection[int], https_ports: Collection[int],
+               services: bool) -> Iterator[str]:
+    addresses = host.findall('./address')
+    if len(addresses) == 0:
+        return
+    # use hostname if present. reverse lookups are ignored.
+    names = [h.get('name') for h in host.findall('./hostnames/hostname') if h.get('type') == 'user']
+    name = names[0] if len(names) else addresses[0].get('addr')
+    for port in host.findall('./ports/port'):
+        state = port.find('state')
+        if state is None or state.get('state') != 'open':
+            continue
+        p = int(port.get('portid'))
+        schemes = _service_schemes(port) if services else set()
+        if p in http_ports:
+            schemes.add('http')
+        if p in https_ports:
+            schemes.add('https')
+        for scheme in sorted(schemes):
+            yield from_host_port(scheme, name, p)
+
+def from_xml(xml_file: str, http_ports: Collection[int], https_ports: Collection[int],
+             services: bool=False) -> Iterator[str]:
+    '''
+    Stream URLs for the open ports in an nmap xml file. Each host is discarded once it has been
+    read so memory does not grow with the size of the file. With `services`, ports where nmap
+    detected an http service are included regardless of the port lists.
+    '''
+    events = ET.iterparse(xml_file, events=('start', 'end'))
+    _, scan = next(events)
     if not scan.tag == 'nmaprun':
         raise ValueError('xml file is not nmap format')
-    urls = set()
-    for host in scan.findall('./host'):
-        open_ports = [int(p.get('portid')) for p in host.findall('./ports/port') if p.find('state').get('state') == 'open']
-        for p in open_ports:
-            addr = host.findall('./address')[0].get('addr')
-            # use hostname if present. reverse lookups are ignored.
-            names = [h.get('name') for h in host.findall('./hostnames/hostname') if h.get('type') == 'user']
-            name = addr
-            if len(names):
-                name = names[0]
-            if p in http_ports:
-                if p == 80:
-                    urls.add('http://{}/'.format(name))
-                else:
-                    urls.add('http://{}:{}/'.format(name, p))
-            if p in https_ports:
-                if p == 443:
-                    urls.add('https://{}/'.format(name))
-                else:
-                    urls.add('https://{}:{}/'.format(name, p))
-    return urls
+    for event, elem in events:
+        if event == 'end' and elem.tag == 'host':
+            yield from _host_urls(elem, http_ports, https_ports, services)
+            # hosts are children of the root. drop the ones we are done with
+            scan.clear()
@@ -0,0 +1,95 @@
+import ssl
+import asyncio
+import logging
+import urllib.parse
+from collections.abc import Iterable
+
+from webshooter.targets.workers import run_all
+
+logger = logging.getLogger(__package__)
+
+DEFAULT_TIMEOUT = 3.0
+DEFAULT_CONCURRENCY = 500
+
+class Scheme:
+    # nothing is listening or the host does not resolve
+    CLOSED=None
+    # accepts connections but does not complete a TLS handshake
+    PLAIN='http'
+    TLS='https'
+
+def _tls_context() -> ssl.SSLContext:
+    # we only care that a handshake completes, not that the certificate is any good
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    ctx.minimum_version = ssl.TLSVersion.MINIMUM_SUPPORTED
+    try:
+        ctx.set_ciphers('ALL:@SECLEVEL=0')
+    except ssl.SSLError:
+        pass
+    return ctx
+
+async def _connect(host: str, port: int, timeout: float, ctx: ssl.SSLContext=None) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ctx, server_hostname=host if ctx else None), timeout)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError, ValueError):
+        return False
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), timeout)
+    except (OSError, ssl.SSLError, asyncio.TimeoutError):
+        pass
+    return True
+
+async def probe_port(host: str, port: int, timeout: float=DEFAULT_TIMEOUT, ctx: ssl.SSLContext=None) -> str:
+    ''' returns the Scheme spoken by host:port '''
+    if not await _connect(host, port, timeout):
+        return Scheme.CLOSED
+    if await _connect(host, port, timeout, ctx or _tls_context()):
+        return Scheme.TLS
+    return Scheme.PLAIN
+
+def host_port(url: str) -> tuple[str, int]:
+    u = urllib.parse.urlparse(url)
+    port = u.port
+    if port is None:
+        port = 443 if u.scheme.lower() == 'https' else 80
+    return u.hostname, port
+
+def probe_urls(urls: Iterable[str], timeout: float=DEFAULT_TIMEOUT,
+               concurrency: int=DEFAULT_CONCURRENCY) -> tuple[set[str], dict[tuple[str, int], str]]:
+    '''
+    Check every host:port in `urls` for a listener and whether it speaks TLS. Returns the URLs
+    that cannot work and the Scheme found for each host:port.
+
+    A URL is dropped if nothing answers on its port, or if it asks for the wrong scheme and the
+    same host:port was also given with the right one (as happens with --all-open and bare hosts).
+    An https URL is also dropped when the port will not complete a TLS handshake.
+    '''
+    by_port: dict[tuple[str, int], set[str]] = {}
+    for u in urls:
+        by_port.setdefault(host_port(u), set()).add(u)
+    if len(by_port) == 0:
+        return set(), {}
+    logger.info('Probing %d host:port pair(s)', len(by_port))
+    ctx = _tls_context()
+    schemes = run_all(list(by_port), lambda p: probe_port(p[0], p[1], timeout, ctx), concurrency)
+
+    invalid = set()
+    for (host, port), port_urls in by_port.items():
+        scheme = schemes[(host, port)]
+        url_schemes = {urllib.parse.urlparse(u).scheme.lower() for u in port_urls}
+        if scheme is Scheme.CLOSED:
+            logger.debug('%s:%d is closed', host, port)
+            invalid.update(port_urls)
+            continue
+        logger.debug('%s:%d speaks %s', host, port, scheme)
+        for u in port_urls:
+            s = urllib.parse.urlparse(u).scheme.lower()
+            if s == scheme:
+                continue
+            if scheme in url_schemes or s == Scheme.TLS:
+                invalid.add(u)
+    return invalid, schemes
@@ -0,0 +1,102 @@
+import ssl
+import asyncio
+import logging
+import urllib.parse
+from collections.abc import Iterable
+from typing import Optional
+
+from webshooter.targets.probe import DEFAULT_TIMEOUT, DEFAULT_CONCURRENCY, _tls_context
+from webshooter.targets.workers import run_all
+from webshooter.screen.session import normalize_url
+
+logger = logging.getLogger(__package__)
+
+MAX_REDIRECTS = 5
+# some servers only redirect browsers
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+# biggest response head we will read
+MAX_HEAD_SIZE = 64 * 1024
+
+async def _fetch_head(url: str, timeout: float, ctx: ssl.SSLContext) -> tuple[int, dict[str, str]]:
+    ''' GET `url` and return the status and headers. the body is never read '''
+    u = urllib.parse.urlparse(url)
+    https = u.scheme.lower() == 'https'
+    port = u.port or (443 if https else 80)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(u.hostname, port, ssl=ctx if https else None, server_hostname=u.hostname if https else None,
+                                limit=MAX_HEAD_SIZE), timeout)
+    try:
+        path = u.path or '/'
+        if u.query:
+            path += '?' + u.query
+        writer.write('GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: {}\r\nAccept: */*\r\nConnection: close\r\n\r\n'.format(
+            path, u.netloc, USER_AGENT).encode('latin-1'))
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+    finally:
+        writer.close()
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+    return status, headers
+
+async def resolve_url(url: str, timeout: float=DEFAULT_TIMEOUT, ctx: ssl.SSLContext=None,
+                      max_redirects: int=MAX_REDIRECTS) -> Optional[str]:
+    ''' follow HTTP redirects from `url` without a browser. returns the final URL or None if it could not be fetched '''
+    ctx = ctx or _tls_context()
+    for _ in range(max_redirects + 1):
+        try:
+            status, headers = await _fetch_head(url, timeout, ctx)
+        except (OSError, ssl.SSLError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, IndexError, UnicodeError) as e:
+            logger.debug('Failed to resolve %s: %s', url, str(e) or type(e).__name__)
+            return None
+        location = headers.get('location')
+        if status not in (301, 302, 303, 307, 308) or not location:
+            return url
+        next_url = urllib.parse.urljoin(url, location)
+        if urllib.parse.urlparse(next_url).scheme.lower() not in ('http', 'https'):
+            return url
+        logger.debug('Redirected: %s -> %s', url, next_url)
+        url = next_url
+    # still redirecting. let the browser sort it out
+    return None
+
+def find_duplicates(urls: Iterable[str], timeout: float=DEFAULT_TIMEOUT, concurrency: int=DEFAULT_CONCURRENCY,
+                    representatives: dict[str, str]=None) -> list[tuple[str, str]]:
+    '''
+    Follow redirects from every URL in `urls` and group them by where they end up. One URL per
+    group is kept for the browser: the one already at the final location if there is one, else
+    the first. Returns (duplicate, representative) pairs for the rest.
+
+    `representatives` maps normalized final URLs to the URL kept for them. It is updated so
+    groups can span several calls. URLs that cannot be fetched are always kept.
+
+    Only HTTP redirects are seen. Pages that redirect with script or a meta refresh are still
+    caught after capture.
+    '''
+    urls = list(urls)
+    if representatives is None:
+        representatives = {}
+    if len(urls) == 0:
+        return []
+    logger.info('Resolving redirects for %d URL(s)', len(urls))
+    ctx = _tls_context()
+    finals = run_all(urls, lambda u: resolve_url(u, timeout, ctx), concurrency)
+
+    groups: dict[str, list[str]] = {}
+    for u in urls:
+        final = finals[u]
+        if final is not None:
+            groups.setdefault(normalize_url(final), []).append(u)
+    duplicates = []
+    for key, group in groups.items():
+        rep = representatives.get(key)
+        if rep is None:
+            rep = next((u for u in group if normalize_url(u) == key), group[0])
+            representatives[key] = rep
+        duplicates += [(u, rep) for u in group if u != rep]
+    return duplicates
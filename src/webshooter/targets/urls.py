@@ -4,11 +4,16 @@ from collections.abc import Iterator
 
 logger = logging.getLogger(__package__)
 
-def process_urls(urls_raw: Iterator[str]) -> set[str]:
+def from_host_port(scheme: str, host: str, port: int) -> str:
+    ''' build a URL, leaving out the port if it is the default for the scheme '''
+    if (scheme, port) in {('http', 80), ('https', 443)}:
+        return '{}://{}/'.format(scheme, host)
+    return '{}://{}:{}/'.format(scheme, host, port)
+
+def process_urls(urls_raw: Iterator[str]) -> Iterator[str]:
     '''
     Make sure every URL has a valid scheme. Drop any URLs that cannot be made valid.
     '''
-    urls = set()
     for u in urls_raw:
         r = urllib.parse.urlparse(u)
         if not r.scheme:
@@ -17,8 +22,8 @@ def process_urls(urls_raw: Iterator[str]) -> set[str]:
             else:
                 if not r.path:
                     u += '/'
-                urls.add('http://'+u)
-                urls.add('https://'+u)
+                yield 'http://'+u
+                yield 'https://'+u
         elif not r.netloc:
             logger.error('invalid URL host: %s', u)
         elif r.scheme not in {'http', 'https'}:
@@ -26,15 +31,11 @@ def process_urls(urls_raw: Iterator[str]) -> set[str]:
         else:
             if not r.path:
                 u += '/'
-            urls.add(u)
-    return urls
+            yield u
 
-def from_file(text_file: str) -> set[str]:
+def from_file(text_file: str) -> Iterator[str]:
     with open(text_file) as fp:
-        return from_iterator(fp)
+        yield from from_iterator(fp)
 
-def from_iterator(urls_raw: Iterator[str]) -> set[str]:
-    urls = set()
-    for u in urls_raw:
-        urls.add(u.strip())
-    return process_urls(urls)
\ No newline at end of file
+def from_iterator(urls_raw: Iterator[str]) -> Iterator[str]:
+    return process_urls(u.strip() for u in urls_raw if u.strip())
\ No newline at end of file
@@ -0,0 +1,24 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+async def _run_all(items: list[Hashable], work: Callable[[Any], Awaitable[Any]], concurrency: int) -> dict[Any, Any]:
+    results = {}
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+    async def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results[item] = await work(item)
+    await asyncio.gather(*[worker() for _ in range(min(concurrency, len(items)))])
+    return results
+
+def run_all(items: list[Hashable], work: Callable[[Any], Awaitable[Any]], concurrency: int) -> dict[Any, Any]:
+    ''' await `work(item)` for every item with at most `concurrency` running at once. returns results by item '''
+    if len(items) == 0:
+        return {}
+    return asyncio.run(_run_all(items, work, concurrency))